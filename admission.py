@@ -0,0 +1,154 @@
+"""Admission control and fair scheduling in front of RunPod submission.
+
+Jobs wait in a local queue until one of max_concurrent slots is free. When a
+slot opens, the next job is picked from sessions holding fewer than
+session_max_running slots, by priority class first, then from the session
+holding the fewest slots, then FIFO. That way one heavy user's batch can't
+starve everyone else, while slots nobody else is waiting for still go to it.
+Requests that would wait longer than max_wait, or that exceed a session's
+pending quota, are shed up front with a clear "busy" message instead of
+piling into the endpoint queue and timing out.
+
+admit() is called from Streamlit threads; acquire()/release()/withdraw() run
+on the job engine's event loop.
+"""
+import asyncio
+import itertools
+import threading
+import time
+from collections import Counter
+
+PRIORITIES = {"interactive": 0, "batch": 1, "background": 2}
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent=8, session_max_running=2, session_max_pending=16,
+                 max_wait=120, default_hold=30.0, alpha=0.2):
+        self.max_concurrent = max_concurrent
+        self.session_max_running = session_max_running
+        self.session_max_pending = session_max_pending
+        self.max_wait = max_wait
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._waiting = []  # [priority, seq, handle, future]
+        self._running = Counter()  # session -> slots held
+        self._pending = Counter()  # session -> waiting + running
+        self._avg_hold = default_hold  # EWMA of how long a job keeps its slot
+        self.admitted = 0
+        self.rejected = 0
+
+    def running(self):
+        with self._lock:
+            return sum(self._running.values())
+
+    def waiting(self):
+        with self._lock:
+            return len(self._waiting)
+
+    def _estimate_wait(self, priority):
+        # Jobs of equal or higher priority go first; each "round" of
+        # max_concurrent jobs takes about one average hold time
+        if sum(self._running.values()) < self.max_concurrent and not self._waiting:
+            return 0.0
+        ahead = sum(1 for entry in self._waiting if entry[0] <= priority)
+        return (ahead // self.max_concurrent + 1) * self._avg_hold
+
+    def admit(self, handle):
+        """Queue handle for a slot; returns an error message if it is shed."""
+        priority = PRIORITIES.get(handle.priority, PRIORITIES["interactive"])
+        with self._lock:
+            if self._pending[handle.session] >= self.session_max_pending:
+                self.rejected += 1
+                return (f"You already have {self._pending[handle.session]} jobs waiting or running; "
+                        f"please wait for some to finish")
+            wait = self._estimate_wait(priority)
+            if wait > self.max_wait:
+                self.rejected += 1
+                return (f"The server is busy (expected wait about {int(wait)} seconds). "
+                        f"Please try again in a moment")
+            self._pending[handle.session] += 1
+            self._waiting.append([priority, next(self._seq), handle, None])
+            self.admitted += 1
+            self._update_positions()
+            return None
+
+    def _pick_order(self):
+        return sorted(
+            self._waiting,
+            key=lambda entry: (entry[0], self._running[entry[2].session], entry[1])
+        )
+
+    def _update_positions(self):
+        for position, entry in enumerate(self._pick_order(), start=1):
+            entry[2].queue_position = position
+
+    def _dispatch(self):
+        # Caller holds the lock; hand free slots to the best waiting entries
+        while sum(self._running.values()) < self.max_concurrent:
+            ready = [entry for entry in self._pick_order() if entry[3] is not None]
+            # Sessions under session_max_running go first; past that, idle
+            # slots still go to whoever is waiting (e.g. one user's parameter
+            # sweep), fewest slots first
+            candidates = [
+                entry for entry in ready if self._running[entry[2].session] < self.session_max_running
+            ] or ready
+            if not candidates:
+                break
+            entry = candidates[0]
+            self._waiting.remove(entry)
+            self._running[entry[2].session] += 1
+            entry[2].queue_position = 0
+            entry[3].set_result(True)
+        self._update_positions()
+
+    async def acquire(self, handle):
+        # True once handle holds a slot; False if it was withdrawn first
+        if handle.done():
+            return False
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            for entry in self._waiting:
+                if entry[2] is handle:
+                    entry[3] = future
+                    break
+            else:
+                # Not queued through admit(); run it straight away
+                future.set_result(True)
+                self._running[handle.session] += 1
+                self._pending[handle.session] += 1
+            self._dispatch()
+        if not await future:
+            return False
+        handle.admitted_at = time.time()
+        return True
+
+    def withdraw(self, handle):
+        # Drop a job that is still waiting for a slot (e.g. cancelled by its
+        # session); returns False if it already holds one
+        with self._lock:
+            for entry in self._waiting:
+                if entry[2] is handle:
+                    break
+            else:
+                return False
+            self._waiting.remove(entry)
+            self._pending[handle.session] -= 1
+            if self._pending[handle.session] <= 0:
+                del self._pending[handle.session]
+            if entry[3] is not None:
+                entry[3].set_result(False)
+            self._update_positions()
+            return True
+
+    def release(self, handle):
+        with self._lock:
+            self._running[handle.session] -= 1
+            self._pending[handle.session] -= 1
+            for counter in (self._running, self._pending):
+                if counter[handle.session] <= 0:
+                    del counter[handle.session]
+            if handle.admitted_at:
+                held = time.time() - handle.admitted_at
+                self._avg_hold += self.alpha * (held - self._avg_hold)
+            self._dispatch()
@@ -1,26 +1,100 @@
 import streamlit as st
-import requests
 import json
-import base64
-from PIL import Image
-import io
 import os
+import socket
+import threading
 import time
 from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from result_cache import ResultCache
+from history import HistoryStore
+from prompt_model import TriggerPrompt
+from runpod_client import RunPodClient
+from endpoint_router import EndpointRouter
+from job_engine import JobEngine
+from job_state import MemoryJobState, SQLiteJobState
+from poll_scheduler import PollScheduler
+from preflight import CostModel, load_manifest, lora_files, merge_duplicate_loras, preflight
+from admission import AdmissionController
+from metrics import MetricsRegistry
+from image_result import ImageResult
+from thumbnails import load_thumbnails
+from warm_pool import WarmPool
+from workflow_template import RenderedWorkflow, WorkflowTemplate, scaled_size
+from batch import extract_images, order_by_seed, seed_branches
 
 # Configure page
 st.set_page_config(page_title="Prateep AI Demo", page_icon="🎨")
 
+@st.cache_resource(show_spinner=False)
+def load_environment():
+    # .env is read once per process; later reruns find it in os.environ
+    load_dotenv()
+
+load_environment()
+
 # Constants
 RUNPOD_ENDPOINT_ID = "gh9cabj4pp1xgs"
-API_BASE = f"https://api.runpod.ai/v2/{RUNPOD_ENDPOINT_ID}"
+# Optional pool of endpoints to route jobs across, as JSON, e.g.
+# [{"id": "abc", "weight": 2, "gpu": "A100"}, {"id": "def", "loras": ["SomTumThai.safetensors"]}]
+RUNPOD_ENDPOINTS = os.getenv("RUNPOD_ENDPOINTS", "")
+HEDGE_AFTER = 45  # Seconds a routed job may queue before a copy goes to a second endpoint (0 disables)
 API_KEY = os.getenv("RUNPOD_API_KEY")
+JOB_STATE_PATH = os.getenv("JOB_STATE_PATH", "")  # SQLite file shared by replicas; in-process when unset
+REPLICA_ID = os.getenv("REPLICA_ID") or socket.gethostname()
+ORPHAN_STALE_AFTER = 30  # Seconds without a poll before another replica takes over a job
+ORPHAN_CHECK_INTERVAL = 15  # Seconds between looks for jobs a stopped replica left behind
+JOB_STATE_KEEP = 3600  # Seconds finished job records are kept (pruned every ORPHAN_CHECK_INTERVAL)
 MAX_TIMEOUT = 300  # 5 minutes timeout
-POLL_INTERVAL = 4  # Check status every 4 seconds
-ERROR_RETRY_DELAY = 4  # Also wait 4 seconds on error before retry
+MAX_JOB_GPU_SECONDS = 120  # Refuse jobs estimated to run longer than this on the GPU
+WORKER_MANIFEST = os.getenv("WORKER_MANIFEST", "")  # JSON {"loras": [...]} of files on the worker
+MANIFEST_TTL = 300  # Seconds before the worker manifest is read again
+POLL_INTERVAL = 4  # Longest gap between status checks
+POLL_MIN_INTERVAL = 0.5  # Shortest gap, used around a job's expected completion
+RUNSYNC_THRESHOLD = 15  # Jobs expected to finish within 15 seconds use /runsync (0 disables)
+RUNSYNC_WAIT = 60  # Seconds RunPod may hold a /runsync request open
+MAX_BATCH_SIZE = 8  # Most images a single batch request may produce
+MAX_SWEEP_CELLS = 12  # Most combinations one parameter sweep may run
+WORKFLOW_TEMPLATE = "workflows/flux_lora_stack.json"
+HIRES_TEMPLATE = "workflows/flux_lora_stack_hires.json"  # Draft-size pass, latent upscale, refine pass
+DRAFT_SIZE = 512  # Longest side of draft renders, in pixels
+DRAFT_STEPS = 8  # Sampler steps for drafts (never more than the Steps slider)
+HIRES_DENOISE = 0.45  # How far the refine pass may move away from the upscaled draft
+HIRES_MIN_STEPS = 4  # Fewest refine steps when finalizing a draft
+THUMBNAIL_DIR = ".cache/thumbnails"
+THUMBNAIL_SIZE = 512  # Longest side of LoRA preview thumbnails, in pixels
+METRICS_FILE = os.getenv("METRICS_FILE", ".cache/metrics.prom")  # Prometheus text, rewritten after each generation
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Serve /metrics on this port when set
+PROGRESS_REFRESH = 1  # Seconds between progress bar updates while waiting
+PREVIEW_EVERY = 5  # Default sampler steps between live preview frames
+PREVIEW_SIZE = 256  # Longest side of live preview frames, in pixels
+PREVIEW_METHOD = "latent2rgb"  # Cheap latent-to-RGB approximation; "taesd" looks better but costs more
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "JPEG")  # Worker encodes results as JPEG, WEBP or PNG
+OUTPUT_QUALITY = 92  # JPEG/WebP quality of results
+# "base64" returns results inline; "url" has the worker upload them to its
+# bucket and return a link, which keeps megabytes out of the status polls
+OUTPUT_TRANSFER = os.getenv("OUTPUT_TRANSFER", "base64")
+MAX_CONCURRENT_JOBS = 8  # Jobs this process keeps submitted to RunPod at once
+SESSION_MAX_RUNNING = 2  # Slots one session may hold while others are waiting
+SESSION_MAX_PENDING = 16  # Jobs one session may have waiting or running
+MAX_EXPECTED_WAIT = 120  # Shed new jobs once the expected local wait exceeds this (seconds)
+HTTP_POOL_SIZE = 20  # Kept-alive connections to RunPod shared by all sessions
+HTTP_CONNECT_TIMEOUT = 5  # Seconds to establish a connection
+HTTP_READ_TIMEOUT = 30  # Seconds to wait for a response once connected
+STATUS_MAX_RETRIES = 4  # Status checks retry with jittered exponential backoff
+WARM_CHECK_INTERVAL = 30  # Seconds between /health checks of the endpoint
+WARM_KEEP_FOR = 15 * 60  # Keep a worker warm this long after the last page view or generation
+WARMUP_GAP = 120  # Fewest seconds between warm-up jobs
+WARM_HOURS = os.getenv("WARM_HOURS", "")  # e.g. "9-18": also keep a worker warm in these local hours
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", ".cache/results")
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 512 MB of images on disk
+RESULT_CACHE_MEMORY_BYTES = 64 * 1024 * 1024  # 64 MB of hot images in memory
+HISTORY_DIR = os.getenv("HISTORY_DIR", ".cache/history")  # Every generated image and its parameters
+HISTORY_PAGE_SIZE = 12  # Thumbnails per gallery page
+HISTORY_THUMBNAIL_SIZE = 256  # Longest side of gallery thumbnails, in pixels
+RERUN_BUDGET = 0.15  # Seconds a rerun that only redraws the page should take
+HISTORY_PERIODS = {"Any time": None, "Last 24 hours": 24 * 3600, "Last 7 days": 7 * 24 * 3600,
+                   "Last 30 days": 30 * 24 * 3600}
 
 # LoRA configuration
 LORA_CONFIG = {
@@ -80,295 +154,1022 @@ LORA_CONFIG = {
     }
 }
 
-def get_job_status(job_id):
-    headers = {
-        'Authorization': f'Bearer {API_KEY}'
-    }
-    
+# Page styles; one constant so each rerun sends a single prebuilt element
+APP_CSS = """
+<style>
+.block-container {
+    max-width: 1200px;
+    padding-top: 1rem;
+    padding-bottom: 0rem;
+    margin: auto;
+}
+.element-container img {
+    width: 100%;
+    height: auto;
+}
+.lora-preview {
+    width: 100%;
+    height: 120px;
+    object-fit: cover;
+    border-radius: 8px;
+    margin-bottom: 8px;
+}
+.lora-card {
+    padding: 10px;
+    border: 1px solid #ddd;
+    border-radius: 8px;
+    margin-bottom: 10px;
+    background-color: #f8f9fa;
+}
+.lora-description {
+    font-size: 0.8em;
+    color: #666;
+    margin-top: 4px;
+}
+.lora-placeholder {
+    width: 100%;
+    height: 120px;
+    border-radius: 8px;
+    margin-bottom: 8px;
+    display: flex;
+    align-items: center;
+    justify-content: center;
+    color: #666;
+    font-size: 0.9em;
+}
+.lora-grid {
+    display: grid;
+    grid-template-columns: repeat(2, 1fr);
+    gap: 10px;
+    margin-bottom: 20px;
+}
+.placeholder-box {
+    text-align: center;
+    padding: 2rem;
+    border: 2px dashed #ccc;
+    border-radius: 8px;
+    height: 512px;
+    display: flex;
+    align-items: center;
+    justify-content: center;
+    margin-top: 37px;
+}
+</style>
+"""
+
+@st.cache_resource
+def get_result_cache():
+    # One cache per process, shared by every session
+    return ResultCache(
+        RESULT_CACHE_DIR,
+        max_disk_bytes=RESULT_CACHE_MAX_BYTES,
+        max_memory_bytes=RESULT_CACHE_MEMORY_BYTES
+    )
+
+@st.cache_resource
+def get_history():
+    # Shared by every session; survives restarts
+    return HistoryStore(HISTORY_DIR, thumbnail_size=HISTORY_THUMBNAIL_SIZE)
+
+@st.cache_resource
+def get_lora_thumbnails():
+    # Preview path -> small JPEG bytes, rendered once per process (and reused
+    # across restarts through the content-hash manifest)
+    previews = [config["preview"] for config in LORA_CONFIG.values() if config["preview"]]
+    return load_thumbnails(previews, THUMBNAIL_DIR, max_size=THUMBNAIL_SIZE)
+
+def show_image(result, caption=None, container=st):
+    # See image_result for why output_format matters (and OUTPUT_FORMAT
+    # defaults to JPEG)
+    container.image(result.data, caption=caption, use_column_width=True, output_format=result.display_format)
+
+@st.cache_resource
+def get_metrics():
+    metrics = MetricsRegistry()
+    cache = get_result_cache()
+    metrics.add_collector(lambda: [
+        (f"result_cache_{name}", f"Result cache {name.replace('_', ' ')}", value, {})
+        for name, value in cache.stats().items()
+    ])
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    return metrics
+
+def job_labels(width, height, steps, lora_models):
+    # Metric labels; LoRA names without the file extension, in slot order,
+    # and whether the endpoint had a ready worker (cold starts vs. warm)
+    loras = "+".join(model.replace(".safetensors", "") for model in lora_models)
+    return {"resolution": f"{width}x{height}", "steps": str(steps), "worker_state": get_warm_pool().state(),
+            "loras": loras}
+
+def save_metrics():
     try:
-        response = requests.get(f"{API_BASE}/status/{job_id}", headers=headers)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error checking job status: {str(e)}")
+        get_metrics().write_file(METRICS_FILE)
+    except OSError:
+        pass
+
+@st.cache_resource
+def get_runpod_client():
+    # One pooled client per process so polls reuse kept-alive connections
+    return RunPodClient(
+        RUNPOD_ENDPOINT_ID,
+        API_KEY,
+        base_url=os.getenv("RUNPOD_API_BASE"),
+        pool_size=HTTP_POOL_SIZE,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        max_retries=STATUS_MAX_RETRIES
+    )
+
+@st.cache_resource
+def get_endpoint_router():
+    # None with a single endpoint; otherwise routes every job across RUNPOD_ENDPOINTS
+    if not RUNPOD_ENDPOINTS:
         return None
+    router = EndpointRouter.from_config(
+        json.loads(RUNPOD_ENDPOINTS),
+        API_KEY,
+        hedge_after=HEDGE_AFTER,
+        metrics=get_metrics(),
+        pool_size=HTTP_POOL_SIZE,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        max_retries=STATUS_MAX_RETRIES
+    )
+    get_metrics().add_collector(router.gauges)
+    return router
 
-def generate_image(prompt, negative_prompt="bad quality, low quality, bad image, lowres", 
-                  width=1024, height=1024, steps=20, guidance=3.5, seed=173805153958730,
-                  lora_models=None, lora_strengths=None):
-    if lora_models is None:
-        lora_models = ["None"] * 2
-    if lora_strengths is None:
-        lora_strengths = [1.0] * 2
-        
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {API_KEY}'
-    }
+@st.cache_resource
+def get_job_state():
+    # Job records every replica can read: in this process only, or in
+    # JOB_STATE_PATH on a volume the replicas share
+    # The job engine prunes old records on its orphan check
+    if not JOB_STATE_PATH:
+        return MemoryJobState()
+    return SQLiteJobState(JOB_STATE_PATH)
+
+def store_orphan(engine, handle, cache, history):
+    # A job resumed from a stopped replica: nobody is waiting on it here, so
+    # store its images where the user who asked for it will find them
+    meta = handle.meta or {}
+    if handle.status != 'COMPLETED' or not meta.get("keys"):
+        return
+    try:
+        outputs = [
+            (filename, ImageResult.from_output(data, fetch=lambda url: engine.fetch(handle, url)))
+            for filename, data in extract_images(handle.output)
+        ]
+        if meta.get("seeds"):
+            results = order_by_seed(outputs, meta["seeds"])
+        else:
+            results = [result for _, result in outputs]
+        records = meta.get("records") or [None] * len(results)
+        for key, result, record in zip(meta["keys"], results, records):
+            cache.put(key, result.data)
+            if record is not None:
+                history.add(result.data, result.format, record, workflow_key=key, mode=meta.get("mode"),
+                            session=meta.get("session"), seconds=time.time() - handle.submitted_at,
+                            queue_seconds=handle.queue_seconds, run_seconds=handle.run_seconds)
+    except Exception:
+        # Best effort: the user can still regenerate
+        pass
+
+@st.cache_resource
+def get_job_engine():
+    # All sessions share one event loop for submitting and polling jobs
+    engine = JobEngine(
+        get_runpod_client(),
+        scheduler=PollScheduler(min_interval=POLL_MIN_INTERVAL, max_interval=POLL_INTERVAL),
+        admission=AdmissionController(
+            max_concurrent=MAX_CONCURRENT_JOBS,
+            session_max_running=SESSION_MAX_RUNNING,
+            session_max_pending=SESSION_MAX_PENDING,
+            max_wait=MAX_EXPECTED_WAIT
+        ),
+        poll_interval=POLL_INTERVAL,
+        max_timeout=MAX_TIMEOUT,
+        max_workers=HTTP_POOL_SIZE,
+        sync_threshold=RUNSYNC_THRESHOLD,
+        sync_wait=RUNSYNC_WAIT,
+        metrics=get_metrics(),
+        router=get_endpoint_router(),
+        state=get_job_state(),
+        # The pid and start time make a restarted replica a new one, so it
+        # resumes the jobs its previous run left behind
+        replica=f"{REPLICA_ID}-{os.getpid()}-{int(time.time())}",
+        stale_after=ORPHAN_STALE_AFTER,
+        state_keep=JOB_STATE_KEEP
+    )
+    cache, history = get_result_cache(), get_history()
+    engine.resume_orphans(
+        on_done=lambda handle: threading.Thread(
+            target=store_orphan, args=(engine, handle, cache, history), daemon=True
+        ).start(),
+        interval=ORPHAN_CHECK_INTERVAL
+    )
+    engine.metrics.add_collector(lambda: [
+        ("generation_active_jobs", "Jobs owned by the engine", engine.active_jobs(), {}),
+        ("generation_waiting_jobs", "Jobs waiting for a submission slot", engine.admission.waiting(), {}),
+        ("generation_running_jobs", "Jobs holding a submission slot", engine.admission.running(), {}),
+        ("generation_coalesced_total", "Requests that joined an identical in-flight job", engine.coalesced, {}),
+        ("generation_shared_joins_total", "Requests that joined another replica's job", engine.shared_joins, {}),
+        ("generation_resumed_total", "Jobs taken over from a replica that stopped polling", engine.resumed, {}),
+    ])
+    return engine
+
+@st.cache_resource(ttl=MANIFEST_TTL, show_spinner=False)
+def get_worker_loras():
+    # LoRA files on the worker, or None when there is no manifest to check against
+    if not WORKER_MANIFEST:
+        return None
+    try:
+        return load_manifest(WORKER_MANIFEST)
+    except (OSError, ValueError, KeyError):
+        return None
+
+@st.cache_resource
+def get_cost_model():
+    # Estimated GPU-seconds per workflow, calibrated by completed jobs
+    return CostModel()
+
+def calibrate_cost(workflow, handle):
+    # Run times of jobs that started on a cold endpoint include loading the
+    # models, which says nothing about the per-step rate
+    if handle.labels.get("worker_state") != "cold":
+        get_cost_model().record(workflow.workflow, handle.run_seconds)
+
+def check_workflow(workflow, labels=None):
+    # Problems that would make the job fail or run too long, as one message;
+    # None when it may be submitted
+    graph = workflow.workflow
+    problems, _ = preflight(graph, get_worker_loras(), get_cost_model(), MAX_JOB_GPU_SECONDS)
+    router = get_endpoint_router()
+    if router is not None and not router.can_serve(lora_files(graph)):
+        problems.append(f"No endpoint has the LoRAs {', '.join(lora_files(graph))}")
+    if not problems:
+        return None
+    get_metrics().counter(
+        "generation_preflight_rejected_total", "Jobs refused before submission"
+    ).inc(**(labels or {}))
+    save_metrics()
+    return "; ".join(problems)
+
+@st.cache_resource
+def get_workflow_template():
+    # Parsed, validated and pre-serialized once per process
+    return WorkflowTemplate.load(WORKFLOW_TEMPLATE).compile()
+
+@st.cache_resource
+def get_hires_template():
+    return WorkflowTemplate.load(HIRES_TEMPLATE).compile()
+
+def warm_hours():
+    if not WARM_HOURS:
+        return None
+    start, end = (int(hour) for hour in WARM_HOURS.split("-"))
+    return range(start, end)
+
+@st.cache_resource
+def get_warm_pool():
+    # Watches /health and keeps a worker warm while the app is in use
+    template = get_workflow_template()
     
-    # Update the workflow data with 2 LoRA models
-    data = {
-        "input": {
-            "workflow": {
-                "6": {
-                    "inputs": {
-                        "text": prompt,
-                        "clip": ["40", 1]
-                    },
-                    "class_type": "CLIPTextEncode",
-                    "_meta": {
-                        "title": "CLIP Text Encode (Positive Prompt)"
-                    }
-                },
-                "8": {
-                    "inputs": {
-                        "samples": ["31", 0],
-                        "vae": ["41", 0]
-                    },
-                    "class_type": "VAEDecode",
-                    "_meta": {
-                        "title": "VAE Decode"
-                    }
-                },
-                "9": {
-                    "inputs": {
-                        "filename_prefix": "ComfyUI",
-                        "images": ["8", 0]
-                    },
-                    "class_type": "SaveImage",
-                    "_meta": {
-                        "title": "Save Image"
-                    }
-                },
-                "27": {
-                    "inputs": {
-                        "width": width,
-                        "height": height,
-                        "batch_size": 1
-                    },
-                    "class_type": "EmptySD3LatentImage",
-                    "_meta": {
-                        "title": "EmptySD3LatentImage"
-                    }
-                },
-                "31": {
-                    "inputs": {
-                        "seed": seed,
-                        "steps": steps,
-                        "cfg": 1,
-                        "sampler_name": "euler",
-                        "scheduler": "simple",
-                        "denoise": 1,
-                        "model": ["40", 0],
-                        "positive": ["38", 0],
-                        "negative": ["33", 0],
-                        "latent_image": ["27", 0]
-                    },
-                    "class_type": "KSampler",
-                    "_meta": {
-                        "title": "KSampler"
-                    }
-                },
-                "33": {
-                    "inputs": {
-                        "text": negative_prompt,
-                        "clip": ["40", 1]
-                    },
-                    "class_type": "CLIPTextEncode",
-                    "_meta": {
-                        "title": "CLIP Text Encode (Negative Prompt)"
-                    }
-                },
-                "37": {
-                    "inputs": {
-                        "unet_name": "flux1-dev-fp8.safetensors",
-                        "weight_dtype": "default"
-                    },
-                    "class_type": "UNETLoader",
-                    "_meta": {
-                        "title": "Load Diffusion Model"
-                    }
-                },
-                "38": {
-                    "inputs": {
-                        "guidance": guidance,
-                        "conditioning": ["6", 0]
-                    },
-                    "class_type": "FluxGuidance",
-                    "_meta": {
-                        "title": "FluxGuidance"
-                    }
-                },
-                "39": {
-                    "inputs": {
-                        "clip_name1": "clip_l.safetensors",
-                        "clip_name2": "t5xxl_fp8_e4m3fn.safetensors",
-                        "type": "flux",
-                        "device": "default"
-                    },
-                    "class_type": "DualCLIPLoader",
-                    "_meta": {
-                        "title": "DualCLIPLoader"
-                    }
-                },
-                "40": {
-                    "inputs": {
-                        "lora_01": lora_models[0],
-                        "strength_01": lora_strengths[0],
-                        "lora_02": lora_models[1],
-                        "strength_02": lora_strengths[1],
-                        "lora_03": "None",
-                        "strength_03": 0.0,
-                        "lora_04": "None",
-                        "strength_04": 0.0,
-                        "model": ["37", 0],
-                        "clip": ["39", 0]
-                    },
-                    "class_type": "Lora Loader Stack (rgthree)",
-                    "_meta": {
-                        "title": "Lora Loader Stack (rgthree)"
-                    }
-                },
-                "41": {
-                    "inputs": {
-                        "vae_name": "ae.safetensors"
-                    },
-                    "class_type": "VAELoader",
-                    "_meta": {
-                        "title": "Load VAE"
-                    }
-                }
-            }
-        }
-    }
+    def build_warmup(lora_models):
+        # Smallest useful job: loads the models and LoRAs, samples one step
+        return template.render(
+            prompt="warm-up", negative_prompt="", width=64, height=64, steps=1, seed=0,
+            lora_01=lora_models[0], strength_01=1.0, lora_02=lora_models[1], strength_02=1.0
+        ).payload()
+    
+    pool = WarmPool(
+        get_job_engine(),
+        build_warmup,
+        check_interval=WARM_CHECK_INTERVAL,
+        keep_warm_for=WARM_KEEP_FOR,
+        warmup_gap=WARMUP_GAP,
+        warm_hours=warm_hours(),
+        metrics=get_metrics()
+    )
+    get_metrics().add_collector(pool.gauges)
+    return pool.start()
+
+def show_endpoint_health():
+    pool = get_warm_pool()
+    with st.expander("Endpoint health"):
+        if 'last_rerun' in st.session_state:
+            kind, seconds = st.session_state['last_rerun']
+            st.caption(f"Last {kind} run took {seconds * 1000:.0f} ms "
+                       f"(page redraw budget {RERUN_BUDGET * 1000:.0f} ms)")
+        if pool.health is None:
+            st.caption(f"Health check failed: {pool.error}" if pool.error else "Checking endpoint health...")
+            return
+        workers = pool.health.get("workers", {})
+        jobs = pool.health.get("jobs", {})
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Ready workers", pool.workers_ready())
+        col2.metric("Queued jobs", jobs.get("inQueue", 0))
+        col3.metric("Running jobs", jobs.get("inProgress", 0))
+        st.caption("Workers: " + ", ".join(f"{count} {state}" for state, count in sorted(workers.items())))
+        warmup = (f"last warm-up {int(time.time() - pool.last_warmup)}s ago ({pool.warmups} total)"
+                  if pool.last_warmup else "no warm-ups yet")
+        st.caption(f"Checked {int(time.time() - pool.checked_at)}s ago, {warmup}. "
+                   f"Warm-ups preload: {', '.join(pool.popular_loras())}")
+        router = get_endpoint_router()
+        if router is not None:
+            for endpoint in router.endpoints:
+                latency = f"{endpoint.latency:.0f}s latency" if endpoint.latency is not None else "no jobs yet"
+                state = "up" if endpoint.up() else f"cooling down after {endpoint.failures} errors"
+                st.caption(f"{endpoint.name}{f' ({endpoint.gpu})' if endpoint.gpu else ''}: {state}, "
+                           f"{endpoint.reported_jobs()} queued/running, {endpoint.in_flight} ours, {latency}")
+
+def build_workflow(prompt, negative_prompt, width, height, steps, guidance, seed,
+                   lora_models, lora_strengths, batch_size=1, hires=None):
+    # Fill the compiled ComfyUI workflow (2 LoRA models) for one request;
+    # hires holds the upscale slots of the two-stage template. A LoRA picked
+    # in both slots is loaded once at the summed strength (the same model)
+    started = time.perf_counter()
+    lora_models, lora_strengths = merge_duplicate_loras(lora_models, lora_strengths)
+    template = get_workflow_template() if hires is None else get_hires_template()
+    workflow = template.render(
+        prompt=prompt,
+        negative_prompt=negative_prompt,
+        width=width,
+        height=height,
+        batch_size=batch_size,
+        seed=seed,
+        steps=steps,
+        guidance=guidance,
+        lora_01=lora_models[0],
+        strength_01=lora_strengths[0],
+        lora_02=lora_models[1],
+        strength_02=lora_strengths[1],
+        output=output_options(),
+        **(hires or {})
+    )
+    get_metrics().histogram(
+        "generation_payload_build_seconds", "Time to render a workflow payload"
+    ).observe(time.perf_counter() - started, **job_labels(width, height, steps, lora_models))
+    return workflow
+
+def job_progress(handle):
+    # Move smoothly through each phase using the learned queue/run durations
+    # instead of jumping between fixed steps
+    if handle.done():
+        return 1.0
+    if handle.status not in ('IN_QUEUE', 'IN_PROGRESS'):
+        return 0.0
+    expected_queue, expected_run = get_job_engine().scheduler.expected(handle.profile)
+    now = time.time()
+    if handle.status == 'IN_QUEUE':
+        return 0.05 + 0.15 * min(1.0, (now - handle.submitted_at) / max(expected_queue, 1.0))
+    if handle.preview and handle.preview.get("steps"):
+        # Streamed previews report the sampler step, which beats a time estimate
+        return 0.2 + 0.75 * min(1.0, handle.preview["step"] / handle.preview["steps"])
+    started = handle.started_at or now
+    return 0.2 + 0.75 * min(1.0, (now - started) / max(expected_run, 1.0))
+
+def current_session_id():
+    # Streamlit's per-browser-tab session id; used for fair scheduling
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "anonymous"
+
+def track_jobs(handles, joined=0, preview_slot=None, on_done=None):
+    # One progress bar covers any number of concurrent jobs; joined counts
+    # handles that belong to identical jobs started by other sessions.
+    # Streamed previews of a single job are drawn into preview_slot, and
+    # on_done(index) is called from this thread as each handle finishes. If
+    # the script run stops before the jobs finish, this session abandons them
+    job_info = st.empty()
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    
+    changed = threading.Event()
+    for handle in handles:
+        handle.subscribe(lambda _: changed.set())
+    
+    cancel_slot = st.empty()
+    # Clicking reruns the script, which stops this loop like any other rerun
+    cancel_slot.button("Cancel", key="cancel_generation", help="Stop waiting and cancel the job on the GPU")
+    
+    collected = set()
+    
+    def collect_finished():
+        if on_done is None:
+            return
+        for index, handle in enumerate(handles):
+            if index not in collected and handle.done():
+                collected.add(index)
+                on_done(index)
     
     try:
-        # Submit the job
-        response = requests.post(f"{API_BASE}/run", headers=headers, json=data)
-        response.raise_for_status()
-        result = response.json()
-        
-        if 'id' not in result:
-            st.error("No job ID in response")
-            return None
-            
-        job_id = result['id']
-        st.info(f"Job submitted (ID: {job_id})")
-        
-        # Create a progress bar
-        progress_bar = st.progress(0)
-        status_text = st.empty()
+        shown_ids = False
+        shown_preview = None
+        while True:
+            statuses = [handle.status for handle in handles]
+            collect_finished()
         
-        # Poll for job completion
-        start_time = time.time()
-        last_status = None
+            if not shown_ids and all(handle.job_id or handle.done() for handle in handles):
+                job_ids = list(dict.fromkeys(handle.job_id for handle in handles if handle.job_id))
+                if len(job_ids) == 1 and joined:
+                    job_info.info(f"Joined an identical job already in progress (ID: {job_ids[0]})")
+                elif len(job_ids) == 1:
+                    job_info.info(f"Job submitted (ID: {job_ids[0]})")
+                elif job_ids:
+                    shared = f", {joined} shared with other sessions" if joined else ""
+                    job_info.info(f"{len(job_ids)} jobs submitted (IDs: {', '.join(job_ids)}){shared}")
+                shown_ids = True
         
-        while True:
-            # Check timeout
-            if time.time() - start_time > MAX_TIMEOUT:
-                st.error(f"Job timed out after {MAX_TIMEOUT} seconds")
-                return None
-            
-            status_response = get_job_status(job_id)
-            if status_response is None:
-                time.sleep(ERROR_RETRY_DELAY)  # Use shorter error retry delay
-                continue
-                
-            status = status_response.get('status', '')
-            
-            # Update progress bar based on status
-            if status != last_status:
-                if status == 'IN_QUEUE':
-                    progress_bar.progress(0.2)
+            # Update progress bar based on status and learned job timings
+            progress_bar.progress(sum(job_progress(handle) for handle in handles) / len(handles))
+            if len(handles) == 1:
+                status = statuses[0]
+                if status == 'WAITING':
+                    status_text.text(f"Waiting for a free GPU slot (position {handles[0].queue_position})...")
+                elif status == 'IN_QUEUE':
                     status_text.text("Job is queued...")
                 elif status == 'IN_PROGRESS':
-                    progress_bar.progress(0.6)
                     status_text.text("Generating image...")
                 elif status == 'COMPLETED':
-                    progress_bar.progress(1.0)
                     status_text.text("Processing completed!")
-                last_status = status
-            
-            if status == 'COMPLETED':
-                output = status_response.get('output', {})
-                if isinstance(output, dict) and 'message' in output:
-                    try:
-                        image_data = base64.b64decode(output['message'])
-                        image = Image.open(io.BytesIO(image_data))
-                        return image
-                    except Exception as e:
-                        st.error(f"Error decoding image: {str(e)}")
-                        return None
-                else:
-                    st.error(f"Unexpected output format: {output}")
-                    return None
-            elif status in ['FAILED', 'CANCELLED']:
-                progress_bar.progress(1.0)
-                status_text.text(f"Job {status.lower()}")
-                st.error(f"Job {status.lower()}: {status_response.get('error', 'Unknown error')}")
+                elif handles[0].done() and handles[0].job_id:
+                    status_text.text(f"Job {status.lower()}")
+            else:
+                finished = sum(1 for handle in handles if handle.done())
+                running = statuses.count('IN_PROGRESS')
+                waiting = statuses.count('WAITING')
+                waiting_text = f", {waiting} waiting for a GPU slot" if waiting else ""
+                status_text.text(f"{finished}/{len(handles)} jobs finished, {running} generating{waiting_text}...")
+        
+            preview = handles[0].preview if preview_slot is not None and len(handles) == 1 else None
+            if preview is not None and preview is not shown_preview:
+                try:
+                    show_image(ImageResult.from_base64(preview["preview"]),
+                               caption=f"Preview, step {preview.get('step', '?')}/{preview.get('steps', '?')}",
+                               container=preview_slot)
+                except Exception:
+                    # A broken preview frame is not worth failing the job over
+                    pass
+                shown_preview = preview
+        
+            if all(handle.done() for handle in handles):
+                collect_finished()
+                if preview_slot is not None:
+                    preview_slot.empty()
+                cancel_slot.empty()
+                return
+            # Wake on any status change, and at least every PROGRESS_REFRESH to move the bar
+            changed.wait(timeout=PROGRESS_REFRESH)
+            changed.clear()
+    except BaseException:
+        # Stop, a rerun (new Generate click, Cancel) or a closed tab ended
+        # this script run first; nobody is left to see the images
+        engine = get_job_engine()
+        session = current_session_id()
+        for handle in handles:
+            engine.abandon(handle, session, reason="Cancelled by the user")
+        raise
+
+def output_options():
+    # How the worker should encode and return results; see OUTPUT_FORMAT.
+    # Part of every workflow key, so changing them doesn't serve old results
+    return {"format": OUTPUT_FORMAT, "quality": OUTPUT_QUALITY, "transfer": OUTPUT_TRANSFER}
+
+def job_images(handle):
+    # Images of a finished job, or None after reporting why
+    if handle.status == 'COMPLETED':
+        images = extract_images(handle.output)
+        if not images:
+            st.error(f"Unexpected output format: {handle.output}")
+            return None
+        try:
+            started = time.perf_counter()
+            engine = get_job_engine()
+            results = [
+                (filename, ImageResult.from_output(data, fetch=lambda url: engine.fetch(handle, url)))
+                for filename, data in images
+            ]
+            get_metrics().histogram(
+                "generation_decode_seconds", "Base64 decode (or download) and image header parse"
+            ).observe(time.perf_counter() - started, **handle.labels)
+            return results
+        except Exception as e:
+            st.error(f"Error decoding image: {str(e)}")
+            return None
+    
+    if handle.status in ['FAILED', 'CANCELLED'] and handle.job_id:
+        st.error(f"Job {handle.status.lower()}: {handle.error}")
+    else:
+        st.error(handle.error)
+    return None
+
+def cache_keys(workflow):
+    # Extra images from a multi-image workflow are stored as "<key>-<n>"
+    return [workflow.key] + [f"{workflow.key}-{i}" for i in range(1, workflow.images)]
+
+def load_stored(keys):
+    # Result cache first, then the history on disk; None unless every image is found
+    cache = get_result_cache()
+    found = []
+    for key in keys:
+        data = cache.get(key)
+        if data is None:
+            data = get_history().find(key)
+            if data is None:
                 return None
-            
-            time.sleep(POLL_INTERVAL)  # Use shorter polling interval
-            
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error calling the API: {str(e)}")
-        return None
+            cache.put(key, data)
+        found.append(data)
+    return found
+
+def generation_record(prompt, negative_prompt, width, height, steps, guidance, seed,
+                      lora_models, lora_strengths):
+    # What the history stores about how an image was made
+    return dict(prompt=prompt, negative_prompt=negative_prompt, width=width, height=height, steps=steps,
+                guidance=guidance, seed=seed, lora_models=list(lora_models), lora_strengths=list(lora_strengths))
+
+def save_history(results, keys, params, mode, started, handle=None):
+    # params: prompt, negative_prompt, size, steps, guidance, seed and LoRA stack
+    try:
+        for key, result in zip(keys, results):
+            get_history().add(
+                result.data, result.format, params, workflow_key=key, mode=mode,
+                session=current_session_id(), seconds=time.time() - started,
+                queue_seconds=handle.queue_seconds if handle else None,
+                run_seconds=handle.run_seconds if handle else None
+            )
     except Exception as e:
-        st.error(f"An error occurred: {str(e)}")
+        st.warning(f"Could not save to history: {str(e)}")
+
+def job_meta(keys, records, mode, seeds=None):
+    # Stored with the job's shared record, so whichever replica sees the job
+    # finish can cache it and add it to the history
+    meta = {"keys": keys, "records": records, "mode": mode, "session": current_session_id()}
+    if seeds is not None:
+        meta["seeds"] = seeds
+    return meta
+
+def run_workflows(workflows, profile, priority="interactive", labels=None, loras=(), preview_every=0,
+                  preview_slot=None, records=None, mode=None, on_result=None):
+    # Serve what we can from the cache, run the rest concurrently; returns
+    # a list of ImageResult lists (None for failed jobs) aligned with workflows.
+    # profile and labels apply to every workflow, or are lists aligned with them.
+    # With preview_every, the worker streams a preview every that many steps.
+    # records holds the parameters of each workflow for the history; loras
+    # routes the jobs to endpoints that have those LoRAs. on_result(i, images)
+    # is called for each workflow as soon as its images are available
+    workflows = [RenderedWorkflow.from_dict(w, output=output_options()) if isinstance(w, dict) else w
+                 for w in workflows]
+    profiles = profile if isinstance(profile, list) else [profile] * len(workflows)
+    cell_labels = labels if isinstance(labels, list) else [labels] * len(workflows)
+    labels = cell_labels[0]
+    started = time.time()
+    cache = get_result_cache()
+    results = [None] * len(workflows)
+    pending = []
+    refused = {}  # Preflight error -> number of workflows it stopped
+    for i, workflow in enumerate(workflows):
+        # Identical workflows (fixed seed included) always produce the same image
+        keys = cache_keys(workflow)
+        stored = load_stored(keys)
+        if stored is not None:
+            results[i] = [ImageResult(data) for data in stored]
+            if on_result is not None:
+                on_result(i, results[i])
+            continue
+        error = check_workflow(workflow, cell_labels[i])
+        if error is None:
+            pending.append((i, keys))
+        else:
+            refused[error] = refused.get(error, 0) + 1
+    for error, count in refused.items():
+        st.error(f"Not submitted: {error}" + (f" ({count} of {len(workflows)})" if len(workflows) > 1 else ""))
+    
+    cached = len(workflows) - len(pending) - sum(refused.values())
+    if cached:
+        st.info("Loaded from cache (no GPU job needed)" if cached == len(workflows)
+                else f"{cached} of {len(workflows)} results loaded from cache")
+    if not pending:
+        if cached:
+            record_time_to_image(started, "cache", labels)
+        return results
+    
+    # Hand the jobs to the shared engine; this session only waits on the handles
+    engine = get_job_engine()
+    session = current_session_id()
+    preview = {"every": preview_every, "size": PREVIEW_SIZE, "method": PREVIEW_METHOD} if preview_every else None
+    submitted = [
+        engine.submit_or_join(workflows[i].payload(preview=preview), workflows[i].key,
+                              profile=profiles[i], session=session, priority=priority, labels=cell_labels[i],
+                              stream=bool(preview_every), loras=loras,
+                              meta=job_meta(keys, [records[i]] * len(keys) if records else None, mode))
+        for i, keys in pending
+    ]
+    handles = [handle for handle, _ in submitted]
+    
+    def collect(index):
+        # Runs as each job finishes, so results can be shown before the rest
+        i, keys = pending[index]
+        images = job_images(handles[index])
+        if images is None:
+            return
+        if not submitted[index][1]:
+            calibrate_cost(workflows[i], handles[index])
+        results[i] = [result for _, result in images]
+        for key, result in zip(keys, results[i]):
+            cache.put(key, result.data)
+        if records is not None:
+            save_history(results[i], keys, records[i], mode, started, handles[index])
+        if on_result is not None:
+            on_result(i, results[i])
+    
+    # A session can join its own job (the same line twice in prompt-variant
+    # mode); only jobs started elsewhere count as shared
+    shared = {id(handle) for handle, joined in submitted
+              if joined and (handle.adopted or handle.session != session)}
+    track_jobs(handles, joined=len(shared), preview_slot=preview_slot, on_done=collect)
+    record_time_to_image(started, "runpod", labels)
+    return results
+
+def record_time_to_image(started, source, labels):
+    get_metrics().histogram(
+        "generation_time_to_image_seconds", "Click to decoded image, as seen by the session"
+    ).observe(time.time() - started, source=source, **(labels or {}))
+    save_metrics()
+
+def generate_image(prompt, negative_prompt="bad quality, low quality, bad image, lowres", 
+                  width=1024, height=1024, steps=20, guidance=3.5, seed=173805153958730,
+                  lora_models=None, lora_strengths=None, preview_every=0, preview_slot=None, mode="image"):
+    if lora_models is None:
+        lora_models = ["None"] * 2
+    if lora_strengths is None:
+        lora_strengths = [1.0] * 2
+    
+    workflow = build_workflow(prompt, negative_prompt, width, height, steps, guidance, seed,
+                              lora_models, lora_strengths)
+    record = generation_record(prompt, negative_prompt, width, height, steps, guidance, seed,
+                               lora_models, lora_strengths)
+    results = run_workflows([workflow], (width, height, steps),
+                            labels=job_labels(width, height, steps, lora_models), loras=lora_models,
+                            preview_every=preview_every, preview_slot=preview_slot,
+                            records=[record], mode=mode)
+    if results[0] is None:
         return None
+    return results[0][0]
 
-def main():
-    # Add custom CSS for layout
-    st.markdown("""
-        <style>
-        .block-container {
-            max-width: 1200px;
-            padding-top: 1rem;
-            padding-bottom: 0rem;
-            margin: auto;
-        }
-        .element-container img {
-            width: 100%;
-            height: auto;
-        }
-        .lora-preview {
-            width: 100%;
-            height: 120px;
-            object-fit: cover;
-            border-radius: 8px;
-            margin-bottom: 8px;
-        }
-        .lora-card {
-            padding: 10px;
-            border: 1px solid #ddd;
-            border-radius: 8px;
-            margin-bottom: 10px;
-            background-color: #f8f9fa;
-        }
-        .lora-description {
-            font-size: 0.8em;
-            color: #666;
-            margin-top: 4px;
-        }
-        .lora-placeholder {
-            width: 100%;
-            height: 120px;
-            border-radius: 8px;
-            margin-bottom: 8px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: #666;
-            font-size: 0.9em;
+def draft_size(width, height):
+    # Longest side DRAFT_SIZE, aspect ratio kept
+    return scaled_size(width, height, DRAFT_SIZE)
+
+def draft_steps(steps):
+    return min(steps, DRAFT_STEPS)
+
+def generate_draft(prompt, negative_prompt, width, height, steps, guidance, seed,
+                   lora_models, lora_strengths, preview_every=0, preview_slot=None):
+    # Same seed and LoRA stack as the full render, at draft size and steps
+    draft_width, draft_height = draft_size(width, height)
+    return generate_image(prompt, negative_prompt, draft_width, draft_height, draft_steps(steps), guidance,
+                          seed, lora_models, lora_strengths, preview_every=preview_every,
+                          preview_slot=preview_slot, mode="draft")
+
+def finalize_draft(prompt, negative_prompt, width, height, steps, guidance, seed,
+                   lora_models, lora_strengths):
+    # One job: the draft's sampler pass again (same seed, size and steps, so
+    # the same latent), a latent upscale to full size and a short refine
+    draft_width, draft_height = draft_size(width, height)
+    workflow = build_workflow(
+        prompt, negative_prompt, draft_width, draft_height, draft_steps(steps), guidance, seed,
+        lora_models, lora_strengths,
+        hires={
+            "hires_width": width,
+            "hires_height": height,
+            "hires_steps": max(HIRES_MIN_STEPS, round(steps * HIRES_DENOISE)),
+            "denoise": HIRES_DENOISE
         }
-        .lora-grid {
-            display: grid;
-            grid-template-columns: repeat(2, 1fr);
-            gap: 10px;
-            margin-bottom: 20px;
+    )
+    record = generation_record(prompt, negative_prompt, width, height, steps, guidance, seed,
+                               lora_models, lora_strengths)
+    results = run_workflows([workflow], ("hires", width, height, steps),
+                            labels=job_labels(width, height, steps, lora_models), loras=lora_models,
+                            records=[record], mode="final")
+    if results[0] is None:
+        return None
+    return results[0][0]
+
+def generate_seed_sweep(seeds, prompt, negative_prompt, width, height, steps, guidance,
+                        lora_models, lora_strengths):
+    # Seeds already in the cache are skipped; the rest share one workflow with
+    # a sampler branch per seed, so the models load once for the whole sweep
+    started = time.time()
+    labels = job_labels(width, height, steps, lora_models)
+    cache = get_result_cache()
+    images = {}
+    missing = []
+    for seed in seeds:
+        key = build_workflow(prompt, negative_prompt, width, height, steps, guidance, seed,
+                             lora_models, lora_strengths).key
+        stored = load_stored([key])
+        if stored is not None:
+            images[seed] = ImageResult(stored[0])
+        else:
+            missing.append((seed, key))
+    
+    if missing:
+        if len(missing) < len(seeds):
+            st.info(f"{len(seeds) - len(missing)} of {len(seeds)} seeds loaded from cache")
+        missing_seeds = [seed for seed, _ in missing]
+        workflow = RenderedWorkflow.from_dict(seed_branches(
+            build_workflow(prompt, negative_prompt, width, height, steps, guidance, missing_seeds[0],
+                           lora_models, lora_strengths).workflow,
+            missing_seeds
+        ), output=output_options())
+        error = check_workflow(workflow, labels)
+        if error is not None:
+            st.error(f"Not submitted: {error}")
+            return [(f"Seed {seed}", images[seed]) for seed in seeds if seed in images]
+        handle, joined = get_job_engine().submit_or_join(
+            workflow.payload(), workflow.key, profile=(width, height, steps),
+            session=current_session_id(), priority="batch", labels=labels, loras=lora_models,
+            meta=job_meta(
+                [key for _, key in missing],
+                [generation_record(prompt, negative_prompt, width, height, steps, guidance, seed, lora_models,
+                                   lora_strengths) for seed in missing_seeds],
+                "seed_sweep", seeds=missing_seeds
+            )
+        )
+        track_jobs([handle], joined=int(joined))
+        outputs = job_images(handle)
+        if outputs is not None and not joined:
+            calibrate_cost(workflow, handle)
+        if outputs is not None:
+            ordered = order_by_seed(outputs, missing_seeds)
+            for (seed, key), result in zip(missing, ordered):
+                images[seed] = result
+                cache.put(key, result.data)
+                save_history([result], [key], generation_record(prompt, negative_prompt, width, height, steps,
+                                                                guidance, seed, lora_models, lora_strengths),
+                             "seed_sweep", started, handle)
+    else:
+        st.info("Loaded from cache (no GPU job needed)")
+    record_time_to_image(started, "runpod" if missing else "cache", labels)
+    
+    return [(f"Seed {seed}", images[seed]) for seed in seeds if seed in images]
+
+def generate_latent_batch(batch_size, prompt, negative_prompt, width, height, steps, guidance, seed,
+                          lora_models, lora_strengths):
+    # One sampler pass over batch_size latents; cheaper than seed branches but
+    # the images can't be reproduced individually from a seed
+    workflow = build_workflow(prompt, negative_prompt, width, height, steps, guidance, seed,
+                              lora_models, lora_strengths, batch_size=batch_size)
+    record = generation_record(prompt, negative_prompt, width, height, steps, guidance, seed,
+                               lora_models, lora_strengths)
+    results = run_workflows([workflow], (width, height, steps), priority="batch",
+                            labels=job_labels(width, height, steps, lora_models), loras=lora_models,
+                            records=[record], mode="latent_batch")
+    if results[0] is None:
+        return []
+    return [(f"Batch image {i + 1}", result) for i, result in enumerate(results[0])]
+
+def generate_prompt_variants(prompts, negative_prompt, width, height, steps, guidance, seed,
+                             lora_models, lora_strengths):
+    # Each variant is its own job; the engine runs them concurrently
+    workflows = [
+        build_workflow(variant, negative_prompt, width, height, steps, guidance, seed,
+                       lora_models, lora_strengths)
+        for variant in prompts
+    ]
+    records = [
+        generation_record(variant, negative_prompt, width, height, steps, guidance, seed,
+                          lora_models, lora_strengths)
+        for variant in prompts
+    ]
+    results = run_workflows(workflows, (width, height, steps), priority="batch",
+                            labels=job_labels(width, height, steps, lora_models), loras=lora_models,
+                            records=records, mode="prompt_variant")
+    return [
+        (variant, result[0])
+        for variant, result in zip(prompts, results) if result
+    ]
+
+def parse_sweep_values(text, cast, low, high):
+    # "0.5, 0.75, 1" -> [0.5, 0.75, 1.0] in the given order, duplicates dropped;
+    # None when a value doesn't parse or is out of range
+    values = []
+    for part in text.replace(";", ",").split(","):
+        if not part.strip():
+            continue
+        try:
+            value = cast(part.strip())
+        except ValueError:
+            return None
+        if not low <= value <= high:
+            return None
+        if value not in values:
+            values.append(value)
+    return values
+
+def generate_parameter_sweep(strengths_01, strengths_02, steps_values, prompt, negative_prompt, width, height,
+                             guidance, seed, lora_models, stream_area=None):
+    """Render every (LoRA 1 strength, LoRA 2 strength, steps) combination.
+
+    Rows of the grid are strength pairs and columns are step counts; all cells
+    share the seed, so only the swept parameters differ. Cells are separate
+    jobs run concurrently (the admission controller bounds how many), cached
+    cells come straight from the cache, and each cell is drawn into
+    stream_area as soon as it is ready. Returns (caption, image) pairs in grid
+    order, with None for failed cells.
+    """
+    cells = [(s1, s2, cell_steps) for s1 in strengths_01 for s2 in strengths_02 for cell_steps in steps_values]
+    
+    def caption(s1, s2, cell_steps):
+        parts = [f"LoRA 1 {s1:g}" if lora_models[0] != "None" else None,
+                 f"LoRA 2 {s2:g}" if lora_models[1] != "None" else None,
+                 f"{cell_steps} steps"]
+        return " · ".join(part for part in parts if part)
+    
+    captions = [caption(*cell) for cell in cells]
+    slots = []
+    if stream_area is not None:
+        with stream_area.container():
+            grid = st.columns(len(steps_values))
+            for i, text in enumerate(captions):
+                slot = grid[i % len(steps_values)].empty()
+                slot.caption(f"{text} · waiting")
+                slots.append(slot)
+    
+    def show_cell(i, images):
+        if slots:
+            show_image(images[0], caption=captions[i], container=slots[i])
+    
+    workflows = [
+        build_workflow(prompt, negative_prompt, width, height, cell_steps, guidance, seed, lora_models, [s1, s2])
+        for s1, s2, cell_steps in cells
+    ]
+    records = [
+        generation_record(prompt, negative_prompt, width, height, cell_steps, guidance, seed,
+                          lora_models, [s1, s2])
+        for s1, s2, cell_steps in cells
+    ]
+    results = run_workflows(workflows, [(width, height, cell_steps) for _, _, cell_steps in cells],
+                            priority="batch", loras=lora_models,
+                            labels=[job_labels(width, height, cell_steps, lora_models) for _, _, cell_steps in cells],
+                            records=records, mode="parameter_sweep", on_result=show_cell)
+    if stream_area is not None:
+        # The finished grid is drawn from session state like other batches
+        stream_area.empty()
+    return [
+        (text if result else f"{text} · failed", result[0] if result else None)
+        for text, result in zip(captions, results)
+    ]
+
+def entry_caption(entry):
+    return f"Seed {entry['seed']} · {entry['width']}x{entry['height']} · {entry['steps']} steps"
+
+def open_generations(ids):
+    # Show stored generations in the result area (gallery clicks, ?gen= links)
+    history = get_history()
+    images = []
+    for generation_id in ids:
+        entry = history.get(generation_id)
+        if entry is None:
+            continue
+        try:
+            data = history.image(entry["image_sha"], entry["image_format"])
+        except OSError:
+            continue
+        images.append((entry_caption(entry), ImageResult(data)))
+    if not images:
+        return
+    if len(images) == 1:
+        st.session_state['generated_caption'], st.session_state['generated_image'] = images[0]
+        st.session_state.pop('generated_images', None)
+    else:
+        st.session_state['generated_images'] = images
+        st.session_state.pop('generated_image', None)
+    st.session_state.pop('generated_columns', None)
+    st.session_state.pop('draft', None)
+    share_generations(ids)
+
+def share_generations(ids):
+    # The URL names what is on screen, so a refresh or a shared link brings it back
+    value = ",".join(str(generation_id) for generation_id in ids if generation_id)
+    st.session_state['opened_generations'] = value
+    if value:
+        st.query_params["gen"] = value
+    elif "gen" in st.query_params:
+        del st.query_params["gen"]
+
+def share_results(images):
+    share_generations([get_history().id_for(image.data) for image in images])
+
+def set_history_page(page):
+    st.session_state['history_page'] = page
+
+def show_history():
+    # Paginated gallery; only the current page's thumbnails are loaded
+    history = get_history()
+    col1, col2, col3 = st.columns([2, 1, 1])
+    text = col1.text_input("Search prompts", key="history_text", on_change=set_history_page, args=(0,))
+    lora = col2.selectbox("LoRA", ["Any"] + history.loras(), key="history_lora",
+                          on_change=set_history_page, args=(0,))
+    period = col3.selectbox("Date", list(HISTORY_PERIODS), key="history_period",
+                            on_change=set_history_page, args=(0,))
+    since = time.time() - HISTORY_PERIODS[period] if HISTORY_PERIODS[period] else None
+    
+    page = st.session_state.get('history_page', 0)
+    entries, total = history.search(text.strip() or None, None if lora == "Any" else lora, since,
+                                    limit=HISTORY_PAGE_SIZE, offset=page * HISTORY_PAGE_SIZE)
+    if not total:
+        st.caption("No generations match")
+        return
+    
+    grid = st.columns(4)
+    for i, entry in enumerate(entries):
+        with grid[i % 4]:
+            try:
+                thumbnail = history.thumbnail(entry["image_sha"], entry["image_format"])
+            except OSError:
+                continue
+            st.image(thumbnail, caption=entry["prompt"][:60], use_column_width=True, output_format="JPEG")
+            st.button("Open", key=f"history_open_{entry['id']}", help=entry_caption(entry),
+                      on_click=open_generations, args=([entry["id"]],), use_container_width=True)
+    
+    pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
+    col1, col2, col3 = st.columns([1, 2, 1])
+    col1.button("Previous", disabled=page == 0, on_click=set_history_page, args=(page - 1,),
+                use_container_width=True)
+    col2.caption(f"Page {page + 1} of {pages} ({total} generations)")
+    col3.button("Next", disabled=page + 1 >= pages, on_click=set_history_page, args=(page + 1,),
+                use_container_width=True)
+
+def update_trigger_word(slot):
+    # LoRA selectbox callback; it runs before the rerun, so the text area is
+    # drawn with the new trigger word in the same pass
+    model = st.session_state[f"lora_model_{slot}"]
+    st.session_state.prompt_input = st.session_state.trigger_prompt.set_trigger(
+        st.session_state.prompt_input, slot, LORA_CONFIG[model]["triggerword"]
+    )
+
+@st.cache_resource
+def get_lora_cards():
+    # What each LoRA picker draws, derived from LORA_CONFIG once per process:
+    # model -> thumbnail bytes (or placeholder HTML) and trigger word
+    thumbnails = get_lora_thumbnails()
+    cards = {}
+    for model, config in LORA_CONFIG.items():
+        thumbnail = thumbnails.get(config["preview"])
+        cards[model] = {
+            "thumbnail": thumbnail,
+            "placeholder": None if thumbnail else (
+                f'<div class="lora-placeholder" style="background-color: {config["placeholder_color"]}">'
+                f'{config["description"]}</div>'
+            ),
+            "trigger": f"Trigger word: **{config['triggerword']}**" if config["triggerword"] else None,
         }
-        </style>
-    """, unsafe_allow_html=True)
+    return cards
+
+def lora_picker(slot):
+    # Model selectbox, preview and strength slider for one LoRA slot
+    cards = get_lora_cards()
+    options = list(cards)
+    st.markdown(f"#### LoRA {slot + 1}")
+    model = st.selectbox(
+        "Model",
+        options,
+        index=1 if slot == 0 and len(options) > 1 else 0,
+        key=f"lora_model_{slot}",
+        on_change=update_trigger_word,
+        args=(slot,)
+    )
+    card = cards[model]
+    if card["thumbnail"]:
+        st.image(card["thumbnail"], use_column_width=True, output_format="JPEG")
+    else:
+        st.markdown(card["placeholder"], unsafe_allow_html=True)
+    if card["trigger"]:
+        st.info(card["trigger"])
+    strength = st.slider(
+        "Strength",
+        min_value=0.0,
+        max_value=2.0,
+        value=1.0 if model != "None" else 0.0,
+        step=0.05,
+        disabled=(model == "None"),
+        key=f"lora_strength_{slot}"
+    )
+    return model, strength
+
+def record_rerun(seconds):
+    # Script runs that only redraw the page should stay within RERUN_BUDGET;
+    # runs that waited on a generation are labelled separately
+    kind = st.session_state.pop('rerun_kind', "render")
+    metrics = get_metrics()
+    metrics.histogram("app_rerun_seconds", "Time to execute one script run").observe(seconds, kind=kind)
+    if kind == "render" and seconds > RERUN_BUDGET:
+        metrics.counter("app_rerun_over_budget_total", "Page redraws slower than RERUN_BUDGET").inc()
+    st.session_state['last_rerun'] = (kind, seconds)
+
+def main():
+    # Static CSS, sent as one element
+    st.markdown(APP_CSS, unsafe_allow_html=True)
 
     st.markdown("<h1 style='text-align: center; margin-bottom: 2rem;'>🎨 Prateep AI Demo</h1>", unsafe_allow_html=True)
     
@@ -376,15 +1177,22 @@ def main():
         st.error("Please set your RUNPOD_API_KEY in the .env file")
         return
 
-    # Initialize session state for tracking LoRA selections
-    if 'previous_loras' not in st.session_state:
-        st.session_state.previous_loras = ["None", "None"]
-    
-    if 'base_prompt' not in st.session_state:
-        st.session_state.base_prompt = "product photography of Benjarong ornate designs bowl on wooden table in cozy thai kitchen, vegetables on background"
+    # Page views count as activity, so a worker warms up while the user types
+    get_warm_pool().touch()
+
+    # Results linked from the URL (?gen=12 or ?gen=12,13) come from the history
+    linked = st.query_params.get("gen")
+    if linked and linked != st.session_state.get('opened_generations'):
+        open_generations([int(part) for part in linked.split(",") if part.isdigit()])
+
+    # The prompt text and the trigger words inserted into it live in session
+    # state; LoRA changes rewrite both from a selectbox callback
+    if 'prompt_input' not in st.session_state:
+        st.session_state.prompt_input = "product photography of Benjarong ornate designs bowl on wooden table in cozy thai kitchen, vegetables on background"
+    if 'trigger_prompt' not in st.session_state:
+        st.session_state.trigger_prompt = TriggerPrompt(slots=2)
 
     # Initialize LoRA variables at the start
-    lora_options = list(LORA_CONFIG.keys())
     lora_models = []
     lora_strengths = []
 
@@ -395,12 +1203,9 @@ def main():
         # Prompt inputs (moved to top)
         st.markdown("### Prompt")
         
-        # Initialize prompt value
-        prompt_value = st.session_state.get('updated_prompt', st.session_state.base_prompt)
         prompt = st.text_area(
             "Prompt",
             placeholder="Describe what you want to generate...",
-            value=prompt_value,
             height=100,
             key="prompt_input"
         )
@@ -415,134 +1220,12 @@ def main():
         st.markdown("### LoRA Models")
         
         # Create a grid of LoRA selections
-        col1, col2 = st.columns(2)
-        
-        # First LoRA
-        with col1:
-            st.markdown("#### LoRA 1")
-            default_index = 1 if len(lora_options) > 1 else 0
-            model1 = st.selectbox(
-                "Model",
-                lora_options,
-                index=default_index,
-                key="lora_model_0"
-            )
-            
-            # Show preview or placeholder
-            if LORA_CONFIG[model1]["preview"] and os.path.exists(LORA_CONFIG[model1]["preview"]):
-                st.image(LORA_CONFIG[model1]["preview"], use_column_width=True)
-            else:
-                placeholder_color = LORA_CONFIG[model1]["placeholder_color"]
-                st.markdown(f"""
-                    <div class="lora-placeholder" style="background-color: {placeholder_color}">
-                        {LORA_CONFIG[model1]["description"]}
-                    </div>
-                """, unsafe_allow_html=True)
-            
-            # Show trigger word if available
-            if LORA_CONFIG[model1]["triggerword"]:
-                st.info(f"Trigger word: **{LORA_CONFIG[model1]['triggerword']}**")
-            
-            strength1 = st.slider(
-                "Strength",
-                min_value=0.0,
-                max_value=2.0,
-                value=1.0 if model1 != "None" else 0.0,
-                step=0.05,
-                disabled=(model1 == "None"),
-                key="lora_strength_0"
-            )
-            lora_models.append(model1)
-            lora_strengths.append(strength1)
-        
-        # Second LoRA
-        with col2:
-            st.markdown("#### LoRA 2")
-            default_index = 0 if len(lora_options) > 2 else 0
-            model2 = st.selectbox(
-                "Model",
-                lora_options,
-                index=default_index,
-                key="lora_model_1"
-            )
-            
-            # Show preview or placeholder
-            if LORA_CONFIG[model2]["preview"] and os.path.exists(LORA_CONFIG[model2]["preview"]):
-                st.image(LORA_CONFIG[model2]["preview"], use_column_width=True)
-            else:
-                placeholder_color = LORA_CONFIG[model2]["placeholder_color"]
-                st.markdown(f"""
-                    <div class="lora-placeholder" style="background-color: {placeholder_color}">
-                        {LORA_CONFIG[model2]["description"]}
-                    </div>
-                """, unsafe_allow_html=True)
-            
-            # Show trigger word if available
-            if LORA_CONFIG[model2]["triggerword"]:
-                st.info(f"Trigger word: **{LORA_CONFIG[model2]['triggerword']}**")
-            
-            strength2 = st.slider(
-                "Strength",
-                min_value=0.0,
-                max_value=2.0,
-                value=1.0 if model2 != "None" else 0.0,
-                step=0.05,
-                disabled=(model2 == "None"),
-                key="lora_strength_1"
-            )
-            lora_models.append(model2)
-            lora_strengths.append(strength2)
-
-        # Check if LoRA selection changed and update prompt
-        current_loras = [model1, model2]
-        if current_loras != st.session_state.previous_loras:
-            # Get current prompt text
-            current_prompt = prompt if 'prompt' in locals() else st.session_state.get('updated_prompt', st.session_state.base_prompt)
-            
-            # Update the prompt with trigger words
-            trigger_words = []
-            for model in current_loras:
-                if model != "None" and LORA_CONFIG[model]["triggerword"]:
-                    trigger_word = LORA_CONFIG[model]["triggerword"]
-                    # Only add trigger word if it's not already in the prompt
-                    if trigger_word.lower() not in current_prompt.lower():
-                        trigger_words.append(trigger_word)
-            
-            # Build new prompt
-            if trigger_words:
-                # Add new trigger words to the beginning of existing prompt
-                new_prompt = " ".join(trigger_words) + " " + current_prompt
-            else:
-                new_prompt = current_prompt
-            
-            # Update session state
-            st.session_state.previous_loras = current_loras
-            
-            # Force rerun to update the text area
-            if 'updated_prompt' not in st.session_state or st.session_state.updated_prompt != new_prompt:
-                st.session_state.updated_prompt = new_prompt
-                st.rerun()
-
-        # Update base prompt when user manually edits (remove trigger words to get base)
-        current_trigger_words = []
-        for model in current_loras:
-            if model != "None" and LORA_CONFIG[model]["triggerword"]:
-                current_trigger_words.append(LORA_CONFIG[model]["triggerword"])
-        
-        # Extract base prompt by removing trigger words from the beginning
-        if current_trigger_words:
-            # Create a copy of the prompt to work with
-            temp_prompt = prompt
-            # Remove each trigger word if it's at the beginning
-            for trigger_word in current_trigger_words:
-                if temp_prompt.lower().startswith(trigger_word.lower() + " "):
-                    temp_prompt = temp_prompt[len(trigger_word) + 1:]
-                elif temp_prompt.lower().startswith(trigger_word.lower()):
-                    temp_prompt = temp_prompt[len(trigger_word):]
-            st.session_state.base_prompt = temp_prompt.strip()
-        else:
-            st.session_state.base_prompt = prompt
-        
+        for slot, column in enumerate(st.columns(2)):
+            with column:
+                model, strength = lora_picker(slot)
+            lora_models.append(model)
+            lora_strengths.append(strength)
+
         # Generation settings
         st.markdown("### Generation Settings")
         col1, col2 = st.columns(2)
@@ -563,44 +1246,164 @@ def main():
             steps = st.slider("Steps", min_value=1, max_value=100, value=20)
             seed_value = st.number_input("Seed", value=173805153958730)
         
+        # Batch mode: several seeds or prompts per click, shown as a grid
+        batch_mode = st.selectbox(
+            "Batch mode",
+            ["Single image", "Seed sweep", "Latent batch", "Prompt variants", "Parameter sweep"],
+            help="Seed sweep renders consecutive seeds in one job; latent batch samples several "
+                 "images in one pass; prompt variants run one job per line concurrently; parameter "
+                 "sweep compares LoRA strengths and step counts side by side"
+        )
+        if batch_mode in ["Seed sweep", "Latent batch"]:
+            batch_count = st.slider("Images", min_value=2, max_value=MAX_BATCH_SIZE, value=4)
+        elif batch_mode == "Prompt variants":
+            variants_text = st.text_area(
+                "Prompt variants (one per line)",
+                placeholder="One full prompt per line...",
+                height=100
+            )
+        elif batch_mode == "Parameter sweep":
+            sweep_strengths_01 = st.text_input(
+                "LoRA 1 strengths", "0.5, 0.75, 1.0",
+                help="Comma-separated values from 0 to 2; leave empty to keep the slider value"
+            )
+            sweep_strengths_02 = st.text_input(
+                "LoRA 2 strengths", "",
+                help="Comma-separated values from 0 to 2; leave empty to keep the slider value"
+            )
+            sweep_steps = st.text_input(
+                "Steps values", "12, 20",
+                help="Comma-separated step counts; leave empty to keep the Steps slider value"
+            )
+        else:
+            draft_mode = st.checkbox(
+                "Draft mode",
+                help=f"Render at {DRAFT_SIZE} px with at most {DRAFT_STEPS} steps for fast iteration, "
+                     f"then finalize the keepers at full resolution"
+            )
+            live_preview = st.checkbox(
+                "Live preview",
+                help="Stream low-resolution previews while the image is sampled"
+            )
+            if live_preview:
+                preview_every = st.slider("Preview every N steps", min_value=1, max_value=max(1, steps),
+                                          value=min(PREVIEW_EVERY, steps))
+        
         # Generate button
         if st.button("Generate", use_container_width=True, type="primary"):
+            st.session_state['rerun_kind'] = "generate"
+            get_warm_pool().touch(lora_models)
             with st.spinner("Creating your image..."):
-                image = generate_image(
-                    prompt=prompt,
+                params = dict(
                     negative_prompt=negative_prompt,
                     width=width,
                     height=height,
                     steps=steps,
                     guidance=3.5,  # Fixed value instead of slider
-                    seed=seed_value,
                     lora_models=lora_models,
                     lora_strengths=lora_strengths
                 )
-                if image:
-                    # Store the generated image in session state
-                    st.session_state['generated_image'] = image
+                if batch_mode == "Single image":
+                    generate = generate_draft if draft_mode else generate_image
+                    image = generate(
+                        prompt=prompt, seed=seed_value,
+                        preview_every=preview_every if live_preview else 0,
+                        preview_slot=right_col.empty() if live_preview else None,
+                        **params
+                    )
+                    if image:
+                        # Store the generated image in session state
+                        st.session_state['generated_image'] = image
+                        st.session_state.pop('generated_images', None)
+                        st.session_state.pop('generated_caption', None)
+                        share_results([image])
+                        if draft_mode:
+                            # Everything needed to finalize this draft later
+                            st.session_state['draft'] = dict(prompt=prompt, seed=seed_value, **params)
+                        else:
+                            st.session_state.pop('draft', None)
+                else:
+                    columns = 2
+                    if batch_mode == "Seed sweep":
+                        seeds = [int(seed_value) + i for i in range(batch_count)]
+                        images = generate_seed_sweep(seeds, prompt=prompt, **params)
+                    elif batch_mode == "Latent batch":
+                        images = generate_latent_batch(batch_count, prompt=prompt, seed=seed_value, **params)
+                    elif batch_mode == "Parameter sweep":
+                        images = []
+                        # An empty LoRA slot has nothing to sweep
+                        strengths_01 = (parse_sweep_values(sweep_strengths_01, float, 0.0, 2.0)
+                                        if sweep_strengths_01.strip() and lora_models[0] != "None"
+                                        else [lora_strengths[0]])
+                        strengths_02 = (parse_sweep_values(sweep_strengths_02, float, 0.0, 2.0)
+                                        if sweep_strengths_02.strip() and lora_models[1] != "None"
+                                        else [lora_strengths[1]])
+                        steps_values = (parse_sweep_values(sweep_steps, int, 1, 100)
+                                        if sweep_steps.strip() else [steps])
+                        if not strengths_01 or not strengths_02 or not steps_values:
+                            st.error("Sweep values must be comma-separated numbers: strengths from 0 to 2, "
+                                     "steps from 1 to 100")
+                        elif len(strengths_01) * len(strengths_02) * len(steps_values) > MAX_SWEEP_CELLS:
+                            st.error(f"A sweep may run at most {MAX_SWEEP_CELLS} combinations")
+                        else:
+                            images = generate_parameter_sweep(
+                                strengths_01, strengths_02, steps_values, prompt=prompt,
+                                negative_prompt=negative_prompt, width=width, height=height,
+                                guidance=params["guidance"], seed=seed_value, lora_models=lora_models,
+                                stream_area=right_col.empty()
+                            )
+                            columns = len(steps_values)
+                    else:
+                        variants = [line.strip() for line in variants_text.splitlines() if line.strip()]
+                        if variants:
+                            images = generate_prompt_variants(variants[:MAX_BATCH_SIZE], seed=seed_value, **params)
+                        else:
+                            images = []
+                            st.error("Enter at least one prompt variant")
+                    if images:
+                        st.session_state['generated_images'] = images
+                        st.session_state['generated_columns'] = columns
+                        st.session_state.pop('generated_image', None)
+                        st.session_state.pop('draft', None)
+                        share_results([image for _, image in images if image is not None])
+        
+        show_endpoint_health()
 
     # Right column for displaying the image
     with right_col:
-        st.markdown("""
-            <style>
-            .placeholder-box {
-                text-align: center;
-                padding: 2rem;
-                border: 2px dashed #ccc;
-                border-radius: 8px;
-                height: 512px;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                margin-top: 37px;
-            }
-            </style>
-            """, unsafe_allow_html=True)
-            
-        if 'generated_image' in st.session_state:
-            st.image(st.session_state['generated_image'], use_column_width=True)
+        if 'generated_images' in st.session_state:
+            columns = st.session_state.get('generated_columns', 2)
+            grid = st.columns(columns)
+            for i, (caption, image) in enumerate(st.session_state['generated_images']):
+                with grid[i % columns]:
+                    if image is None:
+                        st.caption(caption)
+                    else:
+                        show_image(image, caption=caption)
+        elif 'generated_image' in st.session_state:
+            draft = st.session_state.get('draft')
+            if draft and st.button("Finalize at full resolution", use_container_width=True):
+                st.session_state['rerun_kind'] = "generate"
+                with st.spinner("Rendering full resolution..."):
+                    image = finalize_draft(**draft)
+                if image:
+                    st.session_state['generated_image'] = image
+                    st.session_state.pop('draft', None)
+                    share_results([image])
+                    draft = None
+            if draft:
+                draft_width, draft_height = draft_size(draft['width'], draft['height'])
+                caption = f"Draft {draft_width}x{draft_height}, {draft_steps(draft['steps'])} steps"
+            else:
+                caption = st.session_state.get('generated_caption')
+            show_image(st.session_state['generated_image'], caption=caption)
+        
+        if 'generated_images' in st.session_state or 'generated_image' in st.session_state:
+            cache_stats = get_result_cache().stats()
+            st.caption(
+                f"Result cache: {cache_stats['memory_hits'] + cache_stats['disk_hits']} hits, "
+                f"{cache_stats['misses']} misses"
+            )
         else:
             # Placeholder when no image is generated
             st.markdown("""
@@ -609,5 +1412,10 @@ def main():
                 </div>
                 """, unsafe_allow_html=True)
 
+    if st.checkbox("Show history", help="Browse and reopen past generations without using the GPU"):
+        show_history()
+
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    started = time.perf_counter()
+    main()
+    record_rerun(time.perf_counter() - started)
@@ -0,0 +1,74 @@
+"""Helpers for packing several images into one ComfyUI workflow.
+
+A seed sweep duplicates the sampler -> decode -> save chain once per seed
+while every branch shares the same UNET, CLIP, VAE and LoRA stack nodes, so
+the worker loads the models once for the whole batch.
+"""
+import copy
+
+SAMPLER_NODE = "31"
+DECODE_NODE = "8"
+SAVE_NODE = "9"
+
+
+def seed_prefix(seed):
+    return f"seed_{seed}"
+
+
+def seed_branches(workflow, seeds):
+    # Branch 0 keeps the original node ids; later branches get "<id>_<n>"
+    branched = copy.deepcopy(workflow)
+    for i, seed in enumerate(seeds):
+        suffix = "" if i == 0 else f"_{i}"
+        sampler = copy.deepcopy(workflow[SAMPLER_NODE])
+        sampler["inputs"]["seed"] = seed
+        decode = copy.deepcopy(workflow[DECODE_NODE])
+        decode["inputs"]["samples"] = [SAMPLER_NODE + suffix, 0]
+        save = copy.deepcopy(workflow[SAVE_NODE])
+        save["inputs"]["images"] = [DECODE_NODE + suffix, 0]
+        save["inputs"]["filename_prefix"] = seed_prefix(seed)
+        branched[SAMPLER_NODE + suffix] = sampler
+        branched[DECODE_NODE + suffix] = decode
+        branched[SAVE_NODE + suffix] = save
+    return branched
+
+
+def _image_data(data, kind=None):
+    # Workers that upload results to a bucket return a URL instead of base64
+    if kind == "s3_url" or (isinstance(data, str) and data.startswith(("http://", "https://"))):
+        return {"url": data}
+    return data
+
+
+def extract_images(output):
+    """Return the images in a worker output as (filename, data) pairs.
+
+    Older workers send a single image in output["message"]; newer ones send
+    output["images"] as a list of {"filename", "type", "data"} dicts. data is
+    a base64 string, or {"url": ...} for images uploaded to a bucket (see
+    ImageResult.from_output).
+    """
+    if not isinstance(output, dict):
+        return None
+    if isinstance(output.get("images"), list):
+        return [(image.get("filename"), _image_data(image.get("data"), image.get("type")))
+                for image in output["images"]]
+    message = output.get("message")
+    if isinstance(message, list):
+        return [(None, _image_data(data)) for data in message]
+    if isinstance(message, str):
+        return [(None, _image_data(message))]
+    return None
+
+
+def order_by_seed(images, seeds):
+    # Match branch outputs back to their seeds through the SaveImage prefix;
+    # fall back to output order when the worker doesn't report filenames
+    by_seed = {}
+    for filename, data in images:
+        for seed in seeds:
+            if filename and filename.startswith(seed_prefix(seed) + "_"):
+                by_seed[seed] = data
+    if len(by_seed) == len(seeds):
+        return [by_seed[seed] for seed in seeds]
+    return [data for _, data in images]
@@ -0,0 +1,326 @@
+"""Local stand-in for the RunPod serverless API.
+
+Implements /run, /runsync, /status/{id}, /stream/{id}, /cancel/{id} and
+/health closely enough to drive the app's client and job engine without a
+GPU. Each job sits IN_QUEUE for queue_delay seconds, runs for run_time seconds (both
+with +/- jitter), then completes with a canned base64 image of roughly
+payload_kb, or fails with probability failure_rate. error_rate injects
+transient 503s into status polls to exercise client retries. Jobs whose
+input asks for {"preview": {"every": k}} stream a small preview frame every
+k sampler steps while running. Jobs whose input asks for {"output": {"format":
+"JPEG", "quality": q, "transfer": "url"}} get the image re-encoded, and with
+transfer "url" a link to /images/<name> instead of inline base64, like a worker
+that uploads results to a bucket. JSON responses are gzipped for clients that
+accept it; bytes_sent counts the body bytes per endpoint.
+
+Run standalone with:
+
+    python -m bench.fake_runpod --port 8765 --queue-delay 2 --run-time 8
+
+and point the app at it with RUNPOD_API_BASE=http://127.0.0.1:8765.
+"""
+import argparse
+import base64
+import gzip
+import io
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+
+def canned_image(payload_kb, image_format="PNG"):
+    # Random pixels barely compress, so the PNG size tracks the pixel count
+    side = max(8, int((payload_kb * 1024 / 3) ** 0.5))
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **({"compress_level": 1} if image_format == "PNG" else {}))
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class FakeRunPod:
+    def __init__(self, queue_delay=1.0, run_time=4.0, jitter=0.2, failure_rate=0.0,
+                 error_rate=0.0, payload_kb=1500, seed=None):
+        self.queue_delay = queue_delay
+        self.run_time = run_time
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.image = canned_image(payload_kb)
+        self.preview = canned_image(16, "JPEG")
+        # (format, quality) -> (base64, raw bytes) of the canned image re-encoded
+        self.encoded = {}
+        self.jobs = {}
+        self.requests = Counter()
+        self.bytes_sent = Counter()
+        self.base_url = None
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _spread(self, value):
+        return max(0.0, value * self.random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def create_job(self, payload):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            queue = self._spread(self.queue_delay)
+            run = self._spread(self.run_time)
+            self.jobs[job_id] = {
+                "submitted": now,
+                "started": now + queue,
+                "finished": now + queue + run,
+                "failed": self.random.random() < self.failure_rate,
+                "cancelled": False,
+                "images": self._count_images(payload),
+                "steps": self._steps(payload),
+                "preview_every": ((payload or {}).get("input", {}).get("preview") or {}).get("every", 0),
+                "output": (payload or {}).get("input", {}).get("output") or {},
+                "streamed": 0,
+            }
+        return job_id
+
+    def _count_images(self, payload):
+        workflow = (payload or {}).get("input", {}).get("workflow", {})
+        saves = [node for node in workflow.values() if node.get("class_type") == "SaveImage"]
+        batch_size = workflow.get("27", {}).get("inputs", {}).get("batch_size", 1)
+        return [(node["inputs"].get("filename_prefix", "ComfyUI"), batch_size) for node in saves] or [("ComfyUI", 1)]
+
+    def _steps(self, payload):
+        workflow = (payload or {}).get("input", {}).get("workflow", {})
+        return workflow.get("31", {}).get("inputs", {}).get("steps", 20)
+
+    def job_stream(self, job_id):
+        # Preview chunks for the sampler steps reached since the last read
+        status = self.job_status(job_id)
+        if status is None:
+            return None
+        now = time.time()
+        chunks = []
+        with self._lock:
+            job = self.jobs[job_id]
+            every = job["preview_every"]
+            if every and status["status"] == "IN_PROGRESS":
+                fraction = (now - job["started"]) / max(job["finished"] - job["started"], 1e-6)
+                step = int(fraction * job["steps"]) // every * every
+                for reached in range(job["streamed"] + every, step + 1, every):
+                    chunks.append({"output": {"preview": self.preview, "step": reached, "steps": job["steps"]}})
+                job["streamed"] = max(job["streamed"], step)
+        return {"id": job_id, "status": status["status"], "stream": chunks}
+
+    def job_status(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        now = time.time()
+        response = {"id": job_id}
+        if job["cancelled"]:
+            response["status"] = "CANCELLED"
+        elif now < job["started"]:
+            response["status"] = "IN_QUEUE"
+        elif now < job["finished"]:
+            response["status"] = "IN_PROGRESS"
+        elif job["failed"]:
+            response.update(status="FAILED", error="Simulated worker failure")
+        else:
+            response.update(
+                status="COMPLETED",
+                delayTime=int((job["started"] - job["submitted"]) * 1000),
+                executionTime=int((job["finished"] - job["started"]) * 1000),
+                output=self._output(job),
+            )
+        return response
+
+    def _encode(self, image_format, quality):
+        key = (image_format, quality)
+        with self._lock:
+            if key not in self.encoded:
+                image = Image.open(io.BytesIO(base64.b64decode(self.image)))
+                buffer = io.BytesIO()
+                image.save(buffer, format=image_format, quality=quality)
+                data = buffer.getvalue()
+                self.encoded[key] = (base64.b64encode(data).decode("ascii"), data)
+            return self.encoded[key]
+
+    def _output(self, job):
+        options = job["output"]
+        image_format = (options.get("format") or "PNG").upper()
+        data, extension = self.image, "png"
+        if image_format != "PNG":
+            data, _ = self._encode(image_format, options.get("quality", 90))
+            extension = "jpg" if image_format == "JPEG" else image_format.lower()
+        kind = "base64"
+        if options.get("transfer") == "url":
+            data, kind = f"{self.base_url}/images/{image_format}_{options.get('quality', 90)}.{extension}", "s3_url"
+        images = [
+            {"filename": f"{prefix}_{i + 1:05d}_.{extension}", "type": kind, "data": data}
+            for prefix, batch_size in job["images"] for i in range(batch_size)
+        ]
+        if len(images) == 1:
+            return {"message": data, "status": "success"}
+        return {"images": images, "status": "success"}
+
+    def image_file(self, name):
+        # Raw bytes behind an /images/<format>_<quality>.<ext> link
+        image_format, _, rest = name.partition("_")
+        quality = rest.split(".")[0]
+        if image_format == "PNG":
+            return base64.b64decode(self.image), "image/png"
+        if not quality.isdigit():
+            return None, None
+        _, data = self._encode(image_format, int(quality))
+        return data, Image.MIME.get(image_format, "application/octet-stream")
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if time.time() < job["finished"]:
+                job["cancelled"] = True
+        return self.job_status(job_id)
+
+    def health(self):
+        now = time.time()
+        with self._lock:
+            jobs = list(self.jobs.values())
+        live = [job for job in jobs if not job["cancelled"] and now < job["finished"]]
+        in_queue = sum(1 for job in live if now < job["started"])
+        return {
+            "jobs": {
+                "inQueue": in_queue,
+                "inProgress": len(live) - in_queue,
+                "completed": sum(1 for job in jobs if not job["cancelled"] and now >= job["finished"]),
+            },
+            "workers": {"idle": 1 if not live else 0, "running": len(live) - in_queue},
+        }
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, code, body, endpoint="other"):
+                data = json.dumps(body).encode("utf-8")
+                compressed = "gzip" in self.headers.get("Accept-Encoding", "")
+                if compressed:
+                    data = gzip.compress(data, compresslevel=5)
+                fake.bytes_sent[endpoint] += len(data)
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                if compressed:
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _read_json(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                parts = url.path.strip("/").split("/")
+                endpoint = parts[-1] if parts[-1] in ("run", "runsync") else parts[-2] if len(parts) > 1 else ""
+                fake.requests[endpoint] += 1
+                if endpoint == "run":
+                    job_id = fake.create_job(self._read_json())
+                    self._send(200, {"id": job_id, "status": "IN_QUEUE"}, "run")
+                elif endpoint == "runsync":
+                    job_id = fake.create_job(self._read_json())
+                    wait = int(parse_qs(url.query).get("wait", ["90000"])[0]) / 1000
+                    deadline = time.time() + wait
+                    status = fake.job_status(job_id)
+                    while status["status"] in ("IN_QUEUE", "IN_PROGRESS") and time.time() < deadline:
+                        time.sleep(0.05)
+                        status = fake.job_status(job_id)
+                    self._send(200, status, "runsync")
+                elif endpoint == "cancel":
+                    status = fake.cancel(parts[-1])
+                    self._send(200 if status else 404, status or {"error": "job not found"}, "cancel")
+                else:
+                    self._send(404, {"error": "not found"})
+
+            def do_GET(self):
+                parts = urlparse(self.path).path.strip("/").split("/")
+                if parts[-1] == "health":
+                    fake.requests["health"] += 1
+                    self._send(200, fake.health(), "health")
+                elif len(parts) > 1 and parts[-2] == "status":
+                    fake.requests["status"] += 1
+                    if fake.random.random() < fake.error_rate:
+                        self._send(503, {"error": "Simulated transient error"})
+                        return
+                    status = fake.job_status(parts[-1])
+                    self._send(200 if status else 404, status or {"error": "job not found"}, "status")
+                elif len(parts) > 1 and parts[-2] == "images":
+                    fake.requests["images"] += 1
+                    data, mimetype = fake.image_file(parts[-1])
+                    if data is None:
+                        self._send(404, {"error": "not found"})
+                        return
+                    fake.bytes_sent["images"] += len(data)
+                    self.send_response(200)
+                    self.send_header("Content-Type", mimetype)
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                elif len(parts) > 1 and parts[-2] == "stream":
+                    fake.requests["stream"] += 1
+                    stream = fake.job_stream(parts[-1])
+                    self._send(200 if stream else 404, stream or {"error": "job not found"}, "stream")
+                else:
+                    self._send(404, {"error": "not found"})
+
+        return Handler
+
+    def start(self, host="127.0.0.1", port=0):
+        self._server = ThreadingHTTPServer((host, port), self.make_handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="fake-runpod", daemon=True).start()
+        self.base_url = f"http://{host}:{self._server.server_port}"
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake RunPod serverless endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--queue-delay", type=float, default=1.0)
+    parser.add_argument("--run-time", type=float, default=4.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--payload-kb", type=int, default=1500)
+    args = parser.parse_args()
+
+    fake = FakeRunPod(args.queue_delay, args.run_time, args.jitter, args.failure_rate,
+                      args.error_rate, args.payload_kb)
+    print(f"Fake RunPod listening on {fake.start(args.host, args.port)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Offline benchmark of the generation client against a fake RunPod endpoint.
+
+Starts bench.fake_runpod in a child process, then drives the real pipeline
+(template render -> JobEngine/RunPodClient submit and poll -> base64 decode)
+from many concurrent sessions and reports throughput, time-to-image
+percentiles, HTTP requests per job, bytes received per job and memory per
+session. The server's own buffers live in the child, so the memory figure is
+the client side only. No GPU credit is used.
+
+Run from the repository root, e.g.:
+
+    python -m bench.run_bench --sessions 50 --jobs 2 --queue-delay 1 --run-time 4
+    python -m bench.run_bench --poll fixed          # the old fixed 4 s polling
+    python -m bench.run_bench --output-format JPEG --transfer url
+"""
+import argparse
+import multiprocessing
+import threading
+import time
+import tracemalloc
+
+from admission import AdmissionController
+from batch import extract_images
+from bench.fake_runpod import FakeRunPod
+from image_result import ImageResult
+from job_engine import JobEngine
+from poll_scheduler import PollScheduler
+from runpod_client import RunPodClient
+from workflow_template import WorkflowTemplate
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def serve_fake(options, conn):
+    # Child process: run the fake endpoint until told to stop, then report
+    # its request and byte counters back
+    fake = FakeRunPod(*options)
+    conn.send(fake.start())
+    conn.recv()
+    fake.stop()
+    conn.send((dict(fake.requests), dict(fake.bytes_sent)))
+
+
+def run_session(engine, template, session, jobs, args, results):
+    for j in range(jobs):
+        started = time.perf_counter()
+        workflow = template.render(
+            prompt=f"benchmark prompt {session}" if not args.identical else "benchmark prompt",
+            seed=session * 1000 + j if not args.identical else j,
+            width=args.width,
+            height=args.height,
+            steps=args.steps,
+            output={"format": args.output_format, "quality": args.quality, "transfer": args.transfer},
+        )
+        handle, _ = engine.submit_or_join(
+            workflow.payload(), workflow.key,
+            profile=(args.width, args.height, args.steps),
+            session=f"session-{session}",
+        )
+        handle.wait()
+        if handle.status == "COMPLETED":
+            images = [ImageResult.from_output(data, fetch=lambda url: engine.fetch(handle, url))
+                      for _, data in extract_images(handle.output)]
+            results.append(("ok", time.perf_counter() - started, len(images)))
+        else:
+            results.append((handle.status.lower(), time.perf_counter() - started, 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the RunPod client against a local fake endpoint")
+    parser.add_argument("--sessions", type=int, default=20, help="concurrent simulated user sessions")
+    parser.add_argument("--jobs", type=int, default=2, help="sequential generations per session")
+    parser.add_argument("--identical", action="store_true", help="all sessions request the same workflow")
+    parser.add_argument("--queue-delay", type=float, default=1.0)
+    parser.add_argument("--run-time", type=float, default=4.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--payload-kb", type=int, default=1500)
+    parser.add_argument("--poll", choices=["adaptive", "fixed"], default="adaptive")
+    parser.add_argument("--poll-interval", type=float, default=4.0)
+    parser.add_argument("--runsync-threshold", type=float, default=0.0)
+    parser.add_argument("--max-concurrent", type=int, default=0, help="admission cap (0 disables)")
+    parser.add_argument("--pool-size", type=int, default=20)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--template", default="workflows/flux_lora_stack.json")
+    parser.add_argument("--output-format", choices=["PNG", "JPEG", "WEBP"], default="PNG")
+    parser.add_argument("--quality", type=int, default=92)
+    parser.add_argument("--transfer", choices=["base64", "url"], default="base64")
+    args = parser.parse_args()
+
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(
+        target=serve_fake, daemon=True,
+        args=((args.queue_delay, args.run_time, args.jitter, args.failure_rate, args.error_rate,
+               args.payload_kb), child_conn)
+    )
+    server.start()
+    base_url = conn.recv()
+    template = WorkflowTemplate.load(args.template).compile()
+    client = RunPodClient("bench", "bench-key", base_url=base_url, pool_size=args.pool_size)
+    scheduler = None
+    if args.poll == "adaptive":
+        scheduler = PollScheduler(max_interval=args.poll_interval,
+                                  default_queue=args.queue_delay, default_run=args.run_time)
+    admission = None
+    if args.max_concurrent:
+        admission = AdmissionController(max_concurrent=args.max_concurrent,
+                                        session_max_running=args.max_concurrent, max_wait=float("inf"))
+    engine = JobEngine(client, scheduler=scheduler, admission=admission, poll_interval=args.poll_interval,
+                       max_workers=args.pool_size, sync_threshold=args.runsync_threshold)
+
+    results = []
+    threads = [
+        threading.Thread(target=run_session, args=(engine, template, i, args.jobs, args, results))
+        for i in range(args.sessions)
+    ]
+    tracemalloc.start()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    engine.shutdown()
+    conn.send("stop")
+    requests_sent, bytes_sent = conn.recv()
+    server.join()
+
+    ok = [seconds for status, seconds, _ in results if status == "ok"]
+    images = sum(count for _, _, count in results)
+    requests_total = sum(requests_sent.values())
+    print(f"sessions={args.sessions} jobs/session={args.jobs} poll={args.poll} "
+          f"runsync<={args.runsync_threshold}s queue={args.queue_delay}s run={args.run_time}s")
+    print(f"completed      {len(ok)}/{len(results)} ({len(results) - len(ok)} failed)")
+    print(f"wall time      {wall:.2f} s")
+    print(f"throughput     {images / wall:.2f} images/s")
+    print(f"time to image  p50={percentile(ok, 50):.2f}s p95={percentile(ok, 95):.2f}s p99={percentile(ok, 99):.2f}s")
+    ideal = args.queue_delay + args.run_time
+    print(f"overhead p50   {percentile(ok, 50) - ideal:+.2f}s vs. {ideal:.2f}s simulated queue+run")
+    print(f"requests/job   {requests_total / max(1, len(results)):.2f} "
+          f"({', '.join(f'{name}={count}' for name, count in sorted(requests_sent.items()))})")
+    received = sum(bytes_sent.values())
+    print(f"bytes/job      {received / max(1, len(results)) / 1024:.0f} KB "
+          f"({', '.join(f'{name}={count / 1024:.0f}KB' for name, count in sorted(bytes_sent.items()))})")
+    print(f"memory/session {peak / max(1, args.sessions) / 1024:.0f} KB peak traced "
+          f"({peak / 1024 / 1024:.1f} MB total)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Route jobs across several RunPod endpoints.
+
+One endpoint caps throughput at its own worker limit, and its queue is the
+only queue. The router holds a pool of endpoints, each with a weight and
+optional capabilities (the LoRAs its workers have, its GPU class), and picks
+one per job: among the endpoints that serve the job's LoRAs and aren't
+cooling down after errors, the one with the lowest expected wait, i.e. its
+load (jobs reported by the last /health, or our own in-flight jobs if that
+is more) times its observed latency, divided by its weight.
+
+Endpoints that error are skipped for a cooldown that doubles with each
+consecutive failure. The engine fails a submission over to the next endpoint
+and, when hedge_after is set, duplicates a job that is still queued after
+that many seconds to a second endpoint; whichever copy starts first wins and
+the other is cancelled while it is still queued, so hedging costs no GPU
+time.
+"""
+import threading
+import time
+
+import requests
+
+from runpod_client import RunPodClient
+
+
+class Endpoint:
+    def __init__(self, client, weight=1.0, loras=None, gpu=None):
+        self.client = client
+        self.name = client.endpoint_id
+        self.weight = weight
+        # LoRA file names the workers have; None means any
+        self.loras = frozenset(loras) if loras is not None else None
+        self.gpu = gpu
+        self.health = None
+        self.latency = None  # EWMA of submission-to-completion seconds
+        self.in_flight = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+    def serves(self, lora_models):
+        if self.loras is None:
+            return True
+        return all(model in self.loras for model in lora_models if model != "None")
+
+    def reported_jobs(self):
+        if self.health is None:
+            return 0
+        jobs = self.health.get("jobs", {})
+        return jobs.get("inQueue", 0) + jobs.get("inProgress", 0)
+
+    def up(self, now=None):
+        return (now or time.time()) >= self.down_until
+
+
+class EndpointRouter:
+    def __init__(self, endpoints, hedge_after=None, cooldown=5.0, max_cooldown=120.0,
+                 latency_alpha=0.3, metrics=None):
+        if not endpoints:
+            raise ValueError("EndpointRouter needs at least one endpoint")
+        self.endpoints = list(endpoints)
+        # Seconds a job may sit IN_QUEUE before a copy goes to another endpoint
+        self.hedge_after = hedge_after
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.latency_alpha = latency_alpha
+        self.metrics = metrics
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, configs, api_key, **kwargs):
+        """Build from dicts like {"id": ..., "weight": 2, "loras": [...], "gpu": "A100"}.
+
+        Other kwargs go to the router if it takes them, else to every RunPodClient.
+        """
+        router_args = {name: kwargs.pop(name) for name in
+                       ("hedge_after", "cooldown", "max_cooldown", "latency_alpha", "metrics") if name in kwargs}
+        endpoints = [
+            Endpoint(
+                RunPodClient(config["id"], api_key, base_url=config.get("base_url"), **kwargs),
+                weight=config.get("weight", 1.0),
+                loras=config.get("loras"),
+                gpu=config.get("gpu"),
+            )
+            for config in configs
+        ]
+        return cls(endpoints, **router_args)
+
+    def find(self, name):
+        # The endpoint a job record names, e.g. when another replica submitted it
+        return next((endpoint for endpoint in self.endpoints if endpoint.name == name), None)
+
+    def can_serve(self, lora_models):
+        # Whether any endpoint has all of lora_models, cooling down or not
+        return any(endpoint.serves(lora_models) for endpoint in self.endpoints)
+
+    def _cost(self, endpoint, default_latency):
+        load = max(endpoint.reported_jobs(), endpoint.in_flight)
+        latency = endpoint.latency if endpoint.latency is not None else default_latency
+        return (1 + load) * latency / endpoint.weight
+
+    def choose(self, lora_models=(), exclude=()):
+        """Best endpoint for a job using lora_models, or None if none can serve it."""
+        now = time.time()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude and e.serves(lora_models)]
+            if not candidates:
+                return None
+            # When everything is cooling down, try the one that recovers first
+            healthy = [e for e in candidates if e.up(now)] or [min(candidates, key=lambda e: e.down_until)]
+            known = [e.latency for e in self.endpoints if e.latency is not None]
+            default_latency = sum(known) / len(known) if known else 1.0
+            return min(healthy, key=lambda e: self._cost(e, default_latency))
+
+    def submitted(self, endpoint):
+        with self._lock:
+            endpoint.in_flight += 1
+        if self.metrics is not None:
+            self.metrics.counter("runpod_routed_jobs_total", "Jobs submitted per endpoint").inc(
+                endpoint=endpoint.name)
+
+    def finished(self, endpoint, seconds=None):
+        # seconds is the job's submission-to-completion time when it completed
+        with self._lock:
+            endpoint.in_flight = max(0, endpoint.in_flight - 1)
+            if seconds is not None:
+                if endpoint.latency is None:
+                    endpoint.latency = seconds
+                else:
+                    endpoint.latency += self.latency_alpha * (seconds - endpoint.latency)
+                endpoint.failures = 0
+
+    def record_failure(self, endpoint):
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.down_until = time.time() + min(
+                self.max_cooldown, self.cooldown * 2 ** (endpoint.failures - 1))
+        if self.metrics is not None:
+            self.metrics.counter("runpod_endpoint_errors_total", "Request failures per endpoint").inc(
+                endpoint=endpoint.name)
+
+    def health(self):
+        """Refresh every endpoint's /health; returns the summed worker and job counts."""
+        total = {"workers": {}, "jobs": {}}
+        error = None
+        for endpoint in self.endpoints:
+            try:
+                endpoint.health = endpoint.client.health()
+            except requests.exceptions.RequestException as e:
+                endpoint.health = None
+                error = e
+                self.record_failure(endpoint)
+                continue
+            for section in ("workers", "jobs"):
+                for state, count in endpoint.health.get(section, {}).items():
+                    total[section][state] = total[section].get(state, 0) + count
+        if error is not None and all(endpoint.health is None for endpoint in self.endpoints):
+            raise error
+        return total
+
+    def gauges(self):
+        # For MetricsRegistry.add_collector
+        gauges = []
+        now = time.time()
+        for endpoint in self.endpoints:
+            labels = {"endpoint": endpoint.name}
+            gauges.append(("runpod_endpoint_up", "0 while an endpoint cools down after errors",
+                           1 if endpoint.up(now) else 0, labels))
+            gauges.append(("runpod_endpoint_in_flight", "Jobs this process has on an endpoint",
+                           endpoint.in_flight, labels))
+            if endpoint.latency is not None:
+                gauges.append(("runpod_endpoint_latency_seconds", "Smoothed submission-to-completion time",
+                               endpoint.latency, labels))
+        return gauges
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.client.close()
@@ -0,0 +1,239 @@
+"""Persistent generation history: SQLite metadata plus content-addressed images.
+
+Every generated image is written once to images/<sha[:2]>/<sha>.<ext> and a
+row describing how it was made (prompt, LoRA stack, seed, size, steps,
+timings, ...) goes into history.sqlite. Rows are indexed by date, by LoRA
+(through a generation_loras side table, since a LoRA can sit in either slot)
+and by workflow key; prompt text is searched through an FTS5 index when the
+SQLite build has it, with a LIKE scan as the fallback.
+
+The workflow key is the same one the result cache uses, so the history also
+serves as a second, unbounded cache tier: a request whose images are already
+in the history is answered from disk instead of the GPU. Gallery thumbnails
+are rendered on first view and kept next to the images.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from thumbnails import render_thumbnail
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    session TEXT,
+    mode TEXT,
+    prompt TEXT NOT NULL,
+    negative_prompt TEXT,
+    width INTEGER,
+    height INTEGER,
+    steps INTEGER,
+    guidance REAL,
+    seed INTEGER,
+    workflow_key TEXT,
+    image_sha TEXT NOT NULL,
+    image_format TEXT,
+    image_bytes INTEGER,
+    seconds REAL,
+    queue_seconds REAL,
+    run_seconds REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS generations_image ON generations (image_sha);
+CREATE INDEX IF NOT EXISTS generations_created ON generations (created_at);
+CREATE INDEX IF NOT EXISTS generations_key ON generations (workflow_key);
+CREATE TABLE IF NOT EXISTS generation_loras (
+    generation_id INTEGER NOT NULL REFERENCES generations (id) ON DELETE CASCADE,
+    slot INTEGER NOT NULL,
+    lora TEXT NOT NULL,
+    strength REAL,
+    PRIMARY KEY (generation_id, slot)
+);
+CREATE INDEX IF NOT EXISTS generation_loras_lora ON generation_loras (lora, generation_id);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5 (
+    prompt, content='generations', content_rowid='id'
+);
+"""
+
+EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+
+class HistoryStore:
+    def __init__(self, root, thumbnail_size=256):
+        self.root = root
+        self.thumbnail_size = thumbnail_size
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        # One connection shared by every session, serialized by _lock
+        self._db = sqlite3.connect(os.path.join(root, "history.sqlite"), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(SCHEMA)
+        try:
+            self._db.executescript(FTS_SCHEMA)
+            self.full_text = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5
+            self.full_text = False
+        self._db.commit()
+
+    def _image_path(self, sha, image_format):
+        extension = EXTENSIONS.get(image_format, "bin")
+        return os.path.join(self.root, "images", sha[:2], f"{sha}.{extension}")
+
+    def _thumbnail_path(self, sha):
+        return os.path.join(self.root, "thumbnails", sha[:2], f"{sha}_{self.thumbnail_size}.jpg")
+
+    def add(self, data, image_format, params, workflow_key=None, mode=None, session=None,
+            seconds=None, queue_seconds=None, run_seconds=None):
+        """Store an image and how it was made; returns its generation id.
+
+        params holds prompt, negative_prompt, width, height, steps, guidance,
+        seed, lora_models and lora_strengths. An image that is already in the
+        history keeps its original row.
+        """
+        sha = hashlib.sha256(data).hexdigest()
+        path = self._image_path(sha, image_format)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        with self._lock:
+            existing = self._db.execute("SELECT id FROM generations WHERE image_sha = ?", (sha,)).fetchone()
+            if existing:
+                return existing["id"]
+            cursor = self._db.execute(
+                "INSERT INTO generations (created_at, session, mode, prompt, negative_prompt, width, height, "
+                "steps, guidance, seed, workflow_key, image_sha, image_format, image_bytes, seconds, "
+                "queue_seconds, run_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), session, mode, params["prompt"], params.get("negative_prompt"),
+                 params.get("width"), params.get("height"), params.get("steps"), params.get("guidance"),
+                 params.get("seed"), workflow_key, sha, image_format, len(data), seconds,
+                 queue_seconds, run_seconds)
+            )
+            generation_id = cursor.lastrowid
+            loras = zip(params.get("lora_models", []), params.get("lora_strengths", []))
+            self._db.executemany(
+                "INSERT INTO generation_loras (generation_id, slot, lora, strength) VALUES (?, ?, ?, ?)",
+                [(generation_id, slot, lora, strength)
+                 for slot, (lora, strength) in enumerate(loras, start=1) if lora != "None"]
+            )
+            if self.full_text:
+                self._db.execute("INSERT INTO generations_fts (rowid, prompt) VALUES (?, ?)",
+                                 (generation_id, params["prompt"]))
+            self._db.commit()
+            return generation_id
+
+    def _where(self, text=None, lora=None, since=None, until=None):
+        clauses, args = [], []
+        text = text.strip() if text else ""
+        if text:
+            if self.full_text:
+                # Each word as a quoted prefix term, so user input can't break the query syntax
+                query = " ".join('"' + word.replace('"', '""') + '"*' for word in text.split())
+                clauses.append("g.id IN (SELECT rowid FROM generations_fts WHERE generations_fts MATCH ?)")
+                args.append(query)
+            else:
+                # The user's % and _ are literal characters, not wildcards
+                pattern = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                clauses.append("g.prompt LIKE ? ESCAPE '\\'")
+                args.append(f"%{pattern}%")
+        if lora:
+            clauses.append("g.id IN (SELECT generation_id FROM generation_loras WHERE lora = ?)")
+            args.append(lora)
+        if since is not None:
+            clauses.append("g.created_at >= ?")
+            args.append(since)
+        if until is not None:
+            clauses.append("g.created_at < ?")
+            args.append(until)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", args
+
+    def _with_loras(self, rows):
+        entries = [dict(row) for row in rows]
+        if not entries:
+            return entries
+        by_id = {entry["id"]: entry for entry in entries}
+        for entry in entries:
+            entry["lora_models"], entry["lora_strengths"] = [], []
+        placeholders = ",".join("?" * len(by_id))
+        for row in self._db.execute(
+            f"SELECT generation_id, lora, strength FROM generation_loras "
+            f"WHERE generation_id IN ({placeholders}) ORDER BY generation_id, slot", list(by_id)
+        ):
+            by_id[row["generation_id"]]["lora_models"].append(row["lora"])
+            by_id[row["generation_id"]]["lora_strengths"].append(row["strength"])
+        return entries
+
+    def search(self, text=None, lora=None, since=None, until=None, limit=24, offset=0):
+        """Newest first; returns (entries for this page, total matches)."""
+        where, args = self._where(text, lora, since, until)
+        with self._lock:
+            total = self._db.execute(f"SELECT COUNT(*) FROM generations g{where}", args).fetchone()[0]
+            rows = self._db.execute(
+                f"SELECT g.* FROM generations g{where} ORDER BY g.created_at DESC LIMIT ? OFFSET ?",
+                args + [limit, offset]
+            ).fetchall()
+            return self._with_loras(rows), total
+
+    def get(self, generation_id):
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM generations WHERE id = ?", (generation_id,)).fetchall()
+            entries = self._with_loras(rows)
+        return entries[0] if entries else None
+
+    def id_for(self, data):
+        # Generation id of an image, by content
+        sha = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            row = self._db.execute("SELECT id FROM generations WHERE image_sha = ?", (sha,)).fetchone()
+        return row["id"] if row else None
+
+    def find(self, workflow_key):
+        # Image bytes previously generated for a workflow (cache) key
+        with self._lock:
+            row = self._db.execute(
+                "SELECT image_sha, image_format FROM generations WHERE workflow_key = ? "
+                "ORDER BY created_at DESC LIMIT 1", (workflow_key,)
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            return self.image(row["image_sha"], row["image_format"])
+        except OSError:
+            return None
+
+    def loras(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT DISTINCT lora FROM generation_loras ORDER BY lora")]
+
+    def image(self, sha, image_format):
+        with open(self._image_path(sha, image_format), "rb") as f:
+            return f.read()
+
+    def thumbnail(self, sha, image_format):
+        # Rendered on first view, then read from disk
+        path = self._thumbnail_path(sha)
+        if not os.path.exists(path):
+            data = render_thumbnail(self._image_path(sha, image_format), self.thumbnail_size)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            return data
+        with open(path, "rb") as f:
+            return f.read()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
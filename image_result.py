@@ -0,0 +1,58 @@
+"""Generated images kept as the worker's original compressed bytes.
+
+st.image serves raw JPEG/PNG bytes as-is when output_format names their
+format, whereas a PIL image (or bytes in any other format, WebP included) is
+re-encoded on every rerun. ImageResult therefore carries the bytes and only
+materializes a PIL image when something actually needs pixels (resizing,
+watermarking, ...).
+"""
+import base64
+import io
+
+from PIL import Image
+
+
+class ImageResult:
+    __slots__ = ("data", "format", "size", "_image")
+
+    def __init__(self, data):
+        self.data = data
+        # Image.open only parses the header here; pixels are not decoded
+        with Image.open(io.BytesIO(data)) as header:
+            self.format = header.format
+            self.size = header.size
+        self._image = None
+
+    @classmethod
+    def from_base64(cls, encoded):
+        return cls(base64.b64decode(encoded))
+
+    @classmethod
+    def from_output(cls, data, fetch=None):
+        # data as returned by batch.extract_images: base64, or {"url": ...}
+        # downloaded with fetch(url)
+        if isinstance(data, dict):
+            if fetch is None:
+                raise ValueError("Image was returned by URL but no fetch function was given")
+            return cls(fetch(data["url"]))
+        return cls.from_base64(data)
+
+    @property
+    def display_format(self):
+        # output_format for st.image that keeps the bytes as they are
+        return self.format if self.format in ("JPEG", "PNG") else "auto"
+
+    @property
+    def mimetype(self):
+        return Image.MIME.get(self.format, "application/octet-stream")
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = Image.open(io.BytesIO(self.data))
+            self._image.load()
+        return self._image
+
+    def release(self):
+        # Drop the decoded pixels but keep the compressed bytes
+        self._image = None
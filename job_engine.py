@@ -0,0 +1,750 @@
+"""Asyncio job engine that owns submission and polling for every session.
+
+All in-flight RunPod jobs in the process are multiplexed on one event loop
+running in a background thread. Blocking HTTP calls go through the shared
+pooled client on a small executor, so an outstanding job costs a coroutine
+sleeping on the loop rather than a Streamlit script thread sleeping in a
+polling loop. Sessions get a JobHandle back and either block on it or
+subscribe to its status changes.
+
+Every handle records the sessions that want its result. When the last of
+them abandons it (rerun, Stop, closed tab), the job is cancelled: dropped
+from the admission queue if it hasn't been submitted yet, otherwise
+cancelled on RunPod through /cancel so no GPU time goes to images nobody
+will see.
+
+Jobs submitted with stream=True read RunPod's /stream endpoint while they
+run, so low-resolution previews the worker yields mid-sampling show up on
+the handle before the final image is ready.
+
+With an EndpointRouter, each job goes to the endpoint the router picks for
+its LoRAs; a submission the endpoint refused or never received is retried
+on the next endpoint, and a job still queued after the router's hedge_after
+is duplicated to a second endpoint. The copy that leaves the queue first is
+kept.
+
+With a state backend (see job_state), keyed jobs are also recorded outside
+the process, so replicas join each other's jobs by workflow key and resume
+jobs whose replica went away.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from job_state import job_record
+
+TERMINAL_STATUSES = {"COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT", "REJECTED"}
+
+
+class JobHandle:
+    def __init__(self, payload, profile=None, session=None, priority="interactive", labels=None,
+                 stream=False, loras=()):
+        self.payload = payload
+        self.profile = profile
+        self.session = session
+        self.priority = priority
+        # Sessions waiting on this job; the original submitter plus joiners
+        self.owners = {session}
+        # Metric labels (resolution, steps, LoRA combination, ...)
+        self.labels = labels or {}
+        self.stream = stream
+        # Workflow key and caller metadata, recorded in the state backend
+        self.key = None
+        self.meta = None
+        # Taken over from the state backend rather than submitted here
+        self.adopted = False
+        # True once this replica stopped polling a job other replicas still watch
+        self.detached = False
+        # LoRA files the job needs, for routing between endpoints
+        self.loras = tuple(loras)
+        # Router Endpoint running the job, and a hedged copy as (endpoint, job_id)
+        self.endpoint = None
+        self.hedge = None
+        self.hedged = False
+        # Latest streamed preview: {"preview": <base64 image>, "step": n, "steps": total}
+        self.preview = None
+        self.job_id = None
+        self.status = "SUBMITTING"
+        self.output = None
+        self.error = None
+        self.created_at = time.time()
+        self.submitted_at = self.created_at
+        self.admitted_at = None
+        self.queue_position = 0
+        self.started_at = None
+        self.completed_at = None
+        self.polls = 0
+        self.joiners = 0
+        self.used_runsync = False
+        # Per-phase timings in seconds, filled in as the job progresses
+        self.submit_seconds = None
+        self.queue_seconds = None
+        self.run_seconds = None
+        self.detection_gap = None
+        self._cond = threading.Condition()
+        self._callbacks = []
+
+    def _set_status(self, status, output=None, error=None):
+        with self._cond:
+            if self.status in TERMINAL_STATUSES:
+                return
+            changed = status != self.status
+            self.status = status
+            if output is not None:
+                self.output = output
+            if error is not None:
+                self.error = error
+            self._cond.notify_all()
+            callbacks = list(self._callbacks) if changed else []
+        self._notify(callbacks)
+
+    def _set_preview(self, preview):
+        with self._cond:
+            if self.status in TERMINAL_STATUSES:
+                return
+            self.preview = preview
+            self._cond.notify_all()
+            callbacks = list(self._callbacks)
+        self._notify(callbacks)
+
+    def _notify(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                # A broken subscriber must not take down the engine loop
+                pass
+
+    def done(self):
+        return self.status in TERMINAL_STATUSES
+
+    def subscribe(self, callback):
+        # Called with the handle on every status change and new preview, from
+        # the engine thread
+        with self._cond:
+            self._callbacks.append(callback)
+
+    def wait(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(self.done, timeout=timeout)
+
+
+class JobEngine:
+    def __init__(self, client, scheduler=None, admission=None, metrics=None, poll_interval=4,
+                 max_timeout=300, max_workers=16, sync_threshold=0, sync_wait=60, stream_interval=1.0,
+                 router=None, state=None, replica=None, stale_after=30, state_keep=3600):
+        self.client = client
+        # With a router, jobs go to its endpoints and client may be None
+        self.router = router
+        # Shared job records (job_state); replica names this process in them,
+        # and a job nobody has polled for stale_after seconds is an orphan.
+        # Records are dropped state_keep seconds after their job finished
+        self.state = state
+        self.replica = replica
+        self.stale_after = stale_after
+        self.state_keep = state_keep
+        self.metrics = metrics
+        # Without a scheduler every job is polled at the fixed poll_interval
+        self.scheduler = scheduler
+        # Without admission control every job is submitted immediately
+        self.admission = admission
+        self.poll_interval = poll_interval
+        self.max_timeout = max_timeout
+        # Jobs expected to finish within sync_threshold seconds go through
+        # /runsync so short jobs usually come back without a single poll
+        self.sync_threshold = sync_threshold
+        self.sync_wait = sync_wait
+        # Longest gap between polls while a streaming job is queued or running
+        self.stream_interval = stream_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="runpod-http")
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="runpod-job-engine", daemon=True)
+        self._thread.start()
+        self._active = set()
+        # handle -> asyncio.Event set on cancellation, to cut a poll sleep short
+        self._wakeups = {}
+        # Single-flight: workflow key -> the handle of the job computing it
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self.coalesced = 0
+        self.shared_joins = 0
+        self.resumed = 0
+
+    def submit(self, payload, profile=None, session=None, priority="interactive", labels=None, stream=False,
+               loras=()):
+        # Safe to call from any thread; returns immediately. profile is the
+        # (width, height, steps) key the poll scheduler learns timings under
+        handle = JobHandle(payload, profile, session, priority, labels, stream, loras)
+        error = self._admit(handle)
+        if error:
+            handle._set_status("REJECTED", error=error)
+        else:
+            self._start(handle)
+        return handle
+
+    def _admit(self, handle):
+        if self.admission is None:
+            return None
+        error = self.admission.admit(handle)
+        if error is None:
+            handle.status = "WAITING"
+        return error
+
+    def _start(self, handle):
+        asyncio.run_coroutine_threadsafe(self._run_job(handle), self._loop)
+
+    def submit_or_join(self, payload, key, profile=None, session=None, priority="interactive", labels=None,
+                       stream=False, loras=(), meta=None):
+        """Submit a job unless an identical one (same key) is already in flight.
+
+        Returns (handle, joined). Everyone who joins shares the first caller's
+        handle, so a burst of identical requests costs one GPU job. A joiner
+        only sees previews if the job it joined was submitted with stream.
+        With a state backend, a job another replica has in flight is joined
+        too; meta (JSON-serializable) is stored with the job's record.
+        """
+        with self._inflight_lock:
+            handle = self._join_local(key, session)
+        if handle is not None:
+            return handle, True
+        # The state backend may block (a shared SQLite file under contention),
+        # so it is asked on the executor and outside _inflight_lock
+        record = self._executor.submit(self.state.join, key).result() if self.state is not None else None
+        with self._inflight_lock:
+            current = self._join_local(key, session)
+            if current is not None:
+                # Another session here submitted or joined it meanwhile
+                if record is not None:
+                    self._executor.submit(self.state.release, key)
+                return current, True
+            handle = JobHandle(payload, profile, session, priority, labels, stream, loras)
+            handle.key, handle.meta = key, meta
+            if record is not None:
+                # Submitted by another replica (or by this one before a
+                # restart); poll the same RunPod job instead of a new one
+                self._adopt(handle, record)
+                self.shared_joins += 1
+                error = None
+            else:
+                error = self._admit(handle)
+            if error is None:
+                # Subscribe before starting so the entry can't outlive the job
+                handle.subscribe(lambda h: self._forget(key, h))
+                self._inflight[key] = handle
+        if error:
+            # Shed jobs are never registered, so nobody joins a rejection
+            handle._set_status("REJECTED", error=error)
+        else:
+            self._start(handle)
+        return handle, record is not None
+
+    def _join_local(self, key, session):
+        # Join this process's live job for key, if any; hold _inflight_lock
+        handle = self._inflight.get(key)
+        if handle is None or handle.done():
+            return None
+        handle.joiners += 1
+        handle.owners.add(session)
+        self.coalesced += 1
+        return handle
+
+    def _adopt(self, handle, record):
+        # Point a fresh handle at a job recorded in the state backend. The
+        # submitting replica owns hedging and the router's in-flight count
+        handle.adopted = handle.hedged = True
+        handle.job_id = record["job_id"]
+        handle.status = record["status"]
+        handle.submitted_at = record["created_at"]
+        if self.router is not None and record["endpoint"]:
+            handle.endpoint = self.router.find(record["endpoint"])
+
+    def resume_orphans(self, on_done=None, interval=None):
+        """Poll jobs no replica has heartbeated for stale_after seconds.
+
+        on_done(handle) is called from the engine thread as each resumed job
+        finishes, e.g. to store its images. With interval, keep looking for
+        orphans (and pruning old records) every interval seconds. Safe to
+        call from any thread.
+        """
+        if self.state is not None:
+            asyncio.run_coroutine_threadsafe(self._resume_orphans(on_done, interval), self._loop)
+
+    async def _resume_orphans(self, on_done, interval):
+        while True:
+            # A job this replica is still polling may look stale when its
+            # status calls stall; claiming it would start a second poller
+            with self._inflight_lock:
+                live = {key for key, handle in self._inflight.items() if not handle.done()}
+            try:
+                records = await self._call(self.state.claim_orphans, self.replica, self.stale_after, live)
+            except Exception:
+                records = []
+            try:
+                await self._call(self.state.prune, self.state_keep)
+            except Exception:
+                pass
+            for record in records:
+                profile = tuple(record["profile"]) if record["profile"] else None
+                handle = JobHandle(None, profile, priority="background", labels=record["labels"],
+                                   loras=record["loras"])
+                handle.key, handle.meta = record["key"], record["meta"]
+                self._adopt(handle, record)
+                if on_done is not None:
+                    handle.subscribe(lambda h: on_done(h) if h.done() else None)
+                with self._inflight_lock:
+                    current = self._inflight.get(handle.key)
+                    if current is None or current.done():
+                        handle.subscribe(lambda h, key=handle.key: self._forget(key, h))
+                        self._inflight[handle.key] = handle
+                self.resumed += 1
+                self._loop.create_task(self._run_job(handle))
+            if not interval:
+                return
+            await asyncio.sleep(interval)
+
+    def _forget(self, key, handle):
+        if handle.done():
+            with self._inflight_lock:
+                if self._inflight.get(key) is handle:
+                    del self._inflight[key]
+
+    def abandon(self, handle, session=None, reason="Cancelled"):
+        """Drop session's interest in handle; cancels the job once nobody wants it.
+
+        Safe to call from any thread, any number of times.
+        """
+        self._loop.call_soon_threadsafe(self._abandon, handle, session, reason)
+
+    def _abandon(self, handle, session, reason):
+        handle.owners.discard(session)
+        if handle.owners:
+            return
+        if self.state is not None and handle.key and handle.job_id and not handle.done():
+            self._loop.create_task(self._release(handle, reason))
+        else:
+            self._cancel(handle, reason)
+
+    async def _release(self, handle, reason):
+        # Drop this replica's watch on a shared job, off the loop thread
+        try:
+            watchers = await self._call(self.state.release, handle.key)
+        except Exception:
+            watchers = 0
+        if handle.owners:
+            # A session joined again while the backend was busy; keep watching
+            try:
+                await self._call(self.state.join, handle.key)
+            except Exception:
+                pass
+            return
+        if watchers > 0:
+            # Other replicas still watch this job; only stop polling here
+            handle.detached = True
+            self._cancel(handle, reason, remote=False)
+        else:
+            self._cancel(handle, reason)
+
+    def cancel(self, handle, reason="Cancelled"):
+        # Cancel regardless of who else is waiting on the job
+        self._loop.call_soon_threadsafe(self._cancel, handle, reason)
+
+    def _cancel(self, handle, reason, remote=True):
+        # Runs on the loop thread, so it can't interleave with a step of _run_job
+        if handle.done():
+            return
+        handle._set_status("CANCELLED", error=reason)
+        if handle in self._wakeups:
+            self._wakeups[handle].set()
+        if self.admission is not None:
+            self.admission.withdraw(handle)
+        if handle.job_id and remote:
+            self._loop.create_task(self._cancel_remote(handle))
+        # Without a job id the /run request is still in flight;
+        # _submit_and_poll cancels the job as soon as the id comes back
+
+    async def _cancel_remote(self, handle):
+        jobs = [(self._client(handle), handle.job_id)]
+        if handle.hedge is not None:
+            hedge_endpoint, hedge_job_id = handle.hedge
+            jobs.append((hedge_endpoint.client, hedge_job_id))
+        for client, job_id in jobs:
+            try:
+                await self._call(client.cancel, job_id)
+            except requests.exceptions.RequestException:
+                # The job runs to completion; only its GPU time is lost
+                pass
+        if self.metrics is not None:
+            self.metrics.counter(
+                "runpod_cancel_requests_total", "Jobs cancelled on RunPod after submission"
+            ).inc(**handle.labels)
+
+    def active_jobs(self):
+        return len(self._active)
+
+    def health(self):
+        # Worker and job counts of the endpoint, or summed over the router's endpoints
+        return (self.router or self.client).health()
+
+    def _client(self, handle):
+        return handle.endpoint.client if handle.endpoint is not None else self.client
+
+    def fetch(self, handle, url):
+        # Download an output the worker returned by URL, through the pooled
+        # client of the endpoint that ran the job
+        return self._client(handle).fetch(url)
+
+    async def _call(self, func, *args):
+        return await self._loop.run_in_executor(self._executor, func, *args)
+
+    async def _run_job(self, handle):
+        self._active.add(handle)
+        self._wakeups[handle] = asyncio.Event()
+        holds_slot = False
+        try:
+            if handle.job_id is not None:
+                # Adopted from the state backend: already submitted, only poll
+                await self._poll_until_done(handle)
+                return
+            if self.admission is not None:
+                holds_slot = await self.admission.acquire(handle)
+            if handle.done():
+                # Cancelled before it was submitted
+                return
+            handle._set_status("SUBMITTING")
+            await self._submit_and_poll(handle)
+        except Exception as e:
+            handle._set_status("FAILED", error=f"An error occurred: {str(e)}")
+        finally:
+            if holds_slot:
+                self.admission.release(handle)
+            self._active.discard(handle)
+            self._wakeups.pop(handle, None)
+            self._release_endpoints(handle)
+            await self._finish_state(handle)
+            self._record_outcome(handle)
+
+    def _use_runsync(self, handle):
+        if not self.sync_threshold or self.scheduler is None:
+            return False
+        return self.scheduler.expected_total(handle.profile) <= self.sync_threshold
+
+    def _next_delay(self, handle):
+        if self.scheduler is None:
+            delay = self.poll_interval
+        else:
+            elapsed = time.time() - handle.submitted_at
+            delay = self.scheduler.next_delay(handle.profile, handle.status, elapsed)
+        if handle.stream and handle.status in ('IN_QUEUE', 'IN_PROGRESS'):
+            # Previews start with the run, so a streaming job is also checked
+            # often while queued to catch that start
+            return min(delay, self.stream_interval)
+        return delay
+
+    def _update(self, handle, status_response):
+        # Apply one /run, /runsync or /status response; True once the job is finished
+        if handle.done():
+            # Cancelled while the request was in flight
+            return True
+        status = status_response.get('status', '')
+        now = time.time()
+        if status == 'IN_PROGRESS' and handle.started_at is None:
+            handle.started_at = now
+        if status == 'COMPLETED':
+            handle.completed_at = now
+            self._measure_phases(handle, status_response)
+            self._record_timings(handle)
+            output = status_response.get('output', {})
+            if isinstance(output, list):
+                # Generator workers aggregate every yield; previews come
+                # first and the final images last
+                output = output[-1] if output else {}
+            handle._set_status(status, output=output)
+            return True
+        if status in ('FAILED', 'CANCELLED', 'TIMED_OUT'):
+            handle._set_status(status, error=status_response.get('error', 'Unknown error'))
+            return True
+        if status:
+            handle._set_status(status)
+        return False
+
+    def _measure_phases(self, handle, status_response):
+        # RunPod reports exact queue (delayTime) and run (executionTime)
+        # durations in ms on completed jobs; fall back to what we observed
+        delay_ms = status_response.get('delayTime')
+        execution_ms = status_response.get('executionTime')
+        if delay_ms is not None and execution_ms is not None:
+            handle.queue_seconds, handle.run_seconds = delay_ms / 1000, execution_ms / 1000
+            if not handle.used_runsync and handle.submit_seconds is not None:
+                # RunPod's clock starts roughly mid-way through our submit
+                # round trip; whatever is left is time the result sat
+                # finished before a poll noticed it
+                finished_at = (handle.submitted_at + handle.submit_seconds / 2
+                               + handle.queue_seconds + handle.run_seconds)
+                handle.detection_gap = max(0.0, handle.completed_at - finished_at)
+        elif handle.started_at:
+            handle.queue_seconds = handle.started_at - handle.submitted_at
+            handle.run_seconds = handle.completed_at - handle.started_at
+
+    def _record_timings(self, handle):
+        if handle.queue_seconds is None:
+            return
+        if self.scheduler is not None:
+            self.scheduler.record(handle.profile, 'IN_QUEUE', handle.queue_seconds)
+            self.scheduler.record(handle.profile, 'IN_PROGRESS', handle.run_seconds)
+        if self.metrics is not None:
+            self.metrics.histogram(
+                "generation_queue_seconds", "Time jobs spent IN_QUEUE on RunPod"
+            ).observe(handle.queue_seconds, **handle.labels)
+            self.metrics.histogram(
+                "generation_run_seconds", "Time jobs spent IN_PROGRESS on RunPod"
+            ).observe(handle.run_seconds, **handle.labels)
+            if handle.detection_gap is not None:
+                self.metrics.histogram(
+                    "generation_detection_gap_seconds", "Delay between a job finishing and our poll noticing"
+                ).observe(handle.detection_gap, **handle.labels)
+
+    def _record_outcome(self, handle):
+        if self.metrics is None:
+            return
+        self.metrics.counter(
+            "generation_jobs_total", "Jobs by final status"
+        ).inc(status=handle.status, **handle.labels)
+        self.metrics.counter(
+            "runpod_status_polls_total", "Status polls issued"
+        ).inc(handle.polls, **handle.labels)
+        if handle.status == 'COMPLETED':
+            self.metrics.histogram(
+                "generation_job_seconds", "Submission to detected completion"
+            ).observe(handle.completed_at - handle.submitted_at, **handle.labels)
+
+    def _release_endpoints(self, handle):
+        if self.router is None:
+            return
+        if handle.endpoint is not None and not handle.adopted:
+            seconds = handle.completed_at - handle.submitted_at if handle.status == 'COMPLETED' else None
+            self.router.finished(handle.endpoint, seconds)
+        if handle.hedge is not None:
+            self.router.finished(handle.hedge[0])
+
+    async def _submit(self, handle):
+        # /run or /runsync, failing over to the next endpoint when routed
+        handle.used_runsync = self._use_runsync(handle)
+        tried = set()
+        while True:
+            endpoint = None
+            if self.router is not None:
+                endpoint = self.router.choose(handle.loras, exclude=tried)
+                if endpoint is None:
+                    raise requests.exceptions.RequestException(
+                        "no endpoint left to try" if tried else "no endpoint serves " + ", ".join(handle.loras))
+            client = endpoint.client if endpoint is not None else self.client
+            try:
+                if handle.used_runsync:
+                    result = await self._call(client.runsync, handle.payload, self.sync_wait)
+                else:
+                    result = await self._call(client.run, handle.payload)
+            except (requests.exceptions.ConnectionError, requests.exceptions.HTTPError):
+                # The endpoint was unreachable or turned the job down, so it
+                # never queued it and the next endpoint may take it
+                if endpoint is None:
+                    raise
+                self.router.record_failure(endpoint)
+                tried.add(endpoint)
+                continue
+            except requests.exceptions.RequestException:
+                # A read timeout may come after RunPod queued the job;
+                # submitting again could run (and bill) it twice
+                if endpoint is not None:
+                    self.router.record_failure(endpoint)
+                raise
+            if endpoint is not None and 'id' in result:
+                handle.endpoint = endpoint
+                self.router.submitted(endpoint)
+            return result
+
+    async def _submit_and_poll(self, handle):
+        handle.submitted_at = time.time()
+        try:
+            result = await self._submit(handle)
+        except requests.exceptions.RequestException as e:
+            handle._set_status("FAILED", error=f"Error calling the API: {str(e)}")
+            return
+        handle.submit_seconds = time.time() - handle.submitted_at
+        if self.metrics is not None:
+            self.metrics.histogram(
+                "generation_submit_seconds", "Round trip of the /run or /runsync request"
+            ).observe(handle.submit_seconds, mode="runsync" if handle.used_runsync else "run", **handle.labels)
+
+        if 'id' not in result:
+            handle._set_status("FAILED", error="No job ID in response")
+            return
+        handle.job_id = result['id']
+        if handle.done():
+            # Cancelled while /run was in flight
+            await self._cancel_remote(handle)
+            return
+        if result.get('status') in (None, ''):
+            result['status'] = 'IN_QUEUE'
+        if self._update(handle, result):
+            return
+        await self._save_state(handle)
+        await self._poll_until_done(handle)
+
+    async def _save_state(self, handle):
+        if self.state is None or handle.key is None:
+            return
+        record = job_record(
+            handle.key, handle.job_id, self.replica,
+            endpoint=handle.endpoint.name if handle.endpoint is not None else None,
+            status=handle.status, created_at=handle.submitted_at, profile=handle.profile,
+            labels=handle.labels, loras=handle.loras, stream=handle.stream, meta=handle.meta
+        )
+        try:
+            await self._call(self.state.put, record)
+        except Exception:
+            # Without its record the job still runs; other replicas just can't join it
+            pass
+
+    async def _touch_state(self, handle):
+        if self.state is None or handle.key is None or handle.done():
+            return
+        try:
+            await self._call(self.state.touch, handle.key, handle.status, handle.job_id,
+                             handle.endpoint.name if handle.endpoint is not None else None)
+        except Exception:
+            pass
+
+    async def _finish_state(self, handle):
+        if self.state is None or handle.key is None or not handle.job_id or handle.detached:
+            return
+        try:
+            await self._call(self.state.finish, handle.key, handle.status, handle.error)
+        except Exception:
+            pass
+
+    async def _poll_until_done(self, handle):
+        deadline = handle.submitted_at + self.max_timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                handle._set_status("TIMED_OUT", error=f"Job timed out after {self.max_timeout} seconds")
+                return
+            await self._sleep(handle, min(self._next_delay(handle), remaining))
+            if handle.done():
+                return
+            await self._maybe_hedge(handle)
+
+            try:
+                handle.polls += 1
+                status_response = await self._poll(handle)
+            except requests.exceptions.RequestException:
+                # The client already retried with backoff; keep polling until the deadline
+                if handle.endpoint is not None:
+                    self.router.record_failure(handle.endpoint)
+                continue
+
+            if self._update(handle, status_response):
+                return
+            await self._touch_state(handle)
+
+    async def _sleep(self, handle, delay):
+        # asyncio.sleep that ends early when the job is cancelled, so its
+        # admission slot is freed straight away
+        try:
+            await asyncio.wait_for(self._wakeups[handle].wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _poll(self, handle):
+        # A running streaming job is read through /stream, which returns the
+        # chunks yielded since the last read; once it stops running, /status
+        # has the final output and timings
+        if handle.stream and handle.status == 'IN_PROGRESS':
+            response = await self._read_stream(handle)
+            if response.get('status') in ('IN_QUEUE', 'IN_PROGRESS'):
+                return response
+        response = await self._call(self._client(handle).status, handle.job_id)
+        if handle.hedge is not None:
+            response = await self._race_hedge(handle, response)
+        if handle.stream and handle.status != 'IN_PROGRESS' and response.get('status') == 'IN_PROGRESS':
+            # Just started: show what it has yielded so far rather than
+            # waiting another stream_interval for the first preview
+            await self._read_stream(handle)
+        return response
+
+    async def _read_stream(self, handle):
+        response = await self._call(self._client(handle).stream, handle.job_id)
+        previews = [
+            chunk['output'] for chunk in response.get('stream') or []
+            if isinstance(chunk.get('output'), dict) and chunk['output'].get('preview')
+        ]
+        if previews:
+            handle._set_preview(previews[-1])
+        return response
+
+    async def _maybe_hedge(self, handle):
+        # Send one copy of a job that has queued too long to another endpoint
+        router = self.router
+        if (router is None or not router.hedge_after or handle.hedged or handle.status != 'IN_QUEUE'
+                or time.time() - handle.submitted_at < router.hedge_after):
+            return
+        handle.hedged = True
+        endpoint = router.choose(handle.loras, exclude={handle.endpoint})
+        if endpoint is None:
+            return
+        try:
+            result = await self._call(endpoint.client.run, handle.payload)
+        except requests.exceptions.RequestException:
+            router.record_failure(endpoint)
+            return
+        if 'id' not in result:
+            return
+        handle.hedge = (endpoint, result['id'])
+        router.submitted(endpoint)
+        if self.metrics is not None:
+            self.metrics.counter("runpod_hedged_jobs_total", "Queued jobs duplicated to a second endpoint").inc(
+                **handle.labels)
+        if handle.done():
+            # Cancelled while the copy was being submitted
+            await self._cancel_remote(handle)
+
+    async def _race_hedge(self, handle, response):
+        # Whichever copy leaves the queue first is kept; the other is cancelled
+        # while still queued. Returns the status response of the kept copy.
+        hedge_endpoint, hedge_job_id = handle.hedge
+        if response.get('status') != 'IN_QUEUE':
+            loser = (hedge_endpoint, hedge_job_id)
+        else:
+            try:
+                hedge_response = await self._call(hedge_endpoint.client.status, hedge_job_id)
+            except requests.exceptions.RequestException:
+                self.router.record_failure(hedge_endpoint)
+                return response
+            hedge_status = hedge_response.get('status')
+            if hedge_status in ('IN_QUEUE', None, ''):
+                return response
+            if hedge_status in ('FAILED', 'CANCELLED', 'TIMED_OUT'):
+                # The copy died; keep waiting on the original
+                loser = (hedge_endpoint, hedge_job_id)
+            else:
+                loser = (handle.endpoint, handle.job_id)
+                handle.endpoint, handle.job_id = hedge_endpoint, hedge_job_id
+                response = hedge_response
+        handle.hedge = None
+        self.router.finished(loser[0])
+        self._loop.create_task(self._cancel_copy(*loser))
+        return response
+
+    async def _cancel_copy(self, endpoint, job_id):
+        try:
+            await self._call(endpoint.client.cancel, job_id)
+        except requests.exceptions.RequestException:
+            pass
+
+    def shutdown(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,233 @@
+"""Job records shared between app replicas.
+
+The job engine keeps its handles in process memory, so on its own a second
+replica can't see what the first one submitted and a restart forgets every
+job in flight. With a state backend the engine also writes a small record per
+keyed job: workflow key -> RunPod job id, endpoint, status, a heartbeat and
+how many replicas are watching it, plus caller metadata (cache keys and
+history parameters). RunPod only needs the job id to report on a job, so:
+
+- a replica asked for a workflow another replica already submitted joins
+  that job and polls it too, instead of paying for a second GPU job;
+- a job nobody has polled for stale_after seconds (its replica restarted or
+  died) is claimed by one live replica, which polls it to completion and
+  stores the result, so the user finds it in the cache and history;
+- a job is only cancelled on RunPod once no replica is watching it.
+
+MemoryJobState is the in-process default. SQLiteJobState keeps the records in
+a SQLite file on a volume the replicas share; the interface (put, get, join,
+touch, release, finish, claim_orphans, prune) is small enough for a Redis
+implementation to provide the same operations atomically.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+# Same as job_engine.TERMINAL_STATUSES (which imports this module)
+TERMINAL_STATUSES = {"COMPLETED", "FAILED", "CANCELLED", "TIMED_OUT", "REJECTED"}
+FIELDS = ("key", "job_id", "endpoint", "status", "error", "replica", "watchers", "created_at",
+          "heartbeat", "profile", "labels", "loras", "stream", "meta")
+JSON_FIELDS = ("profile", "labels", "loras", "meta")
+
+
+def job_record(key, job_id, replica, endpoint=None, status="IN_QUEUE", created_at=None, profile=None,
+               labels=None, loras=(), stream=False, meta=None):
+    now = time.time()
+    return {
+        "key": key, "job_id": job_id, "endpoint": endpoint, "status": status, "error": None,
+        "replica": replica, "watchers": 1, "created_at": created_at or now, "heartbeat": now,
+        "profile": list(profile) if isinstance(profile, tuple) else profile, "labels": labels or {},
+        "loras": list(loras), "stream": bool(stream), "meta": meta,
+    }
+
+
+class MemoryJobState:
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def put(self, record):
+        with self._lock:
+            self._records[record["key"]] = dict(record)
+
+    def get(self, key):
+        with self._lock:
+            record = self._records.get(key)
+            return dict(record) if record else None
+
+    def join(self, key):
+        """Count one more watcher on a live job; returns its record, or None."""
+        with self._lock:
+            record = self._records.get(key)
+            if record is None or record["status"] in TERMINAL_STATUSES or not record["job_id"]:
+                return None
+            record["watchers"] += 1
+            record["heartbeat"] = time.time()
+            return dict(record)
+
+    def touch(self, key, status, job_id, endpoint=None):
+        # Heartbeat from a replica polling the job; a hedged job may have
+        # moved to another job id and endpoint
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None and record["status"] not in TERMINAL_STATUSES:
+                record.update(status=status, job_id=job_id, endpoint=endpoint, heartbeat=time.time())
+
+    def release(self, key):
+        """Drop one watcher; returns how many are left."""
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                return 0
+            record["watchers"] = max(0, record["watchers"] - 1)
+            return record["watchers"]
+
+    def finish(self, key, status, error=None):
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None and record["status"] not in TERMINAL_STATUSES:
+                record.update(status=status, error=error, heartbeat=time.time())
+
+    def claim_orphans(self, replica, stale_after, skip=()):
+        # Live jobs nobody has polled for stale_after seconds, now owned by
+        # replica. Its own jobs and the keys in skip (jobs it still polls,
+        # just slowly) are left alone
+        now = time.time()
+        claimed = []
+        with self._lock:
+            for record in self._records.values():
+                if (record["status"] not in TERMINAL_STATUSES and record["job_id"]
+                        and now - record["heartbeat"] > stale_after
+                        and record["replica"] != replica and record["key"] not in skip):
+                    record.update(replica=replica, heartbeat=now, watchers=record["watchers"] + 1)
+                    claimed.append(dict(record))
+        return claimed
+
+    def prune(self, older_than):
+        # Forget jobs finished more than older_than seconds ago, and any job
+        # submitted that long ago (well past every timeout) that never finished
+        cutoff = time.time() - older_than
+        with self._lock:
+            for key in [key for key, record in self._records.items()
+                        if record["created_at"] < cutoff
+                        or (record["status"] in TERMINAL_STATUSES and record["heartbeat"] < cutoff)]:
+                del self._records[key]
+
+
+class SQLiteJobState:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # isolation_level=None: every statement commits on its own, and the
+        # read-modify-write steps below run inside explicit BEGIN IMMEDIATE
+        # transactions so replicas sharing the file can't interleave them
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS job_state (key TEXT PRIMARY KEY, job_id TEXT, endpoint TEXT, "
+            "status TEXT NOT NULL, error TEXT, replica TEXT, watchers INTEGER NOT NULL, created_at REAL, "
+            "heartbeat REAL NOT NULL, profile TEXT, labels TEXT, loras TEXT, stream INTEGER, meta TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS job_state_heartbeat ON job_state (status, heartbeat)")
+        self._terminal = ",".join("?" * len(TERMINAL_STATUSES))
+        self._terminal_args = sorted(TERMINAL_STATUSES)
+
+    def _row(self, row):
+        record = dict(row)
+        for field in JSON_FIELDS:
+            record[field] = json.loads(record[field]) if record[field] is not None else None
+        record["stream"] = bool(record["stream"])
+        return record
+
+    def put(self, record):
+        values = [json.dumps(record[field]) if field in JSON_FIELDS else record[field] for field in FIELDS]
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO job_state ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))})",
+                values
+            )
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM job_state WHERE key = ?", (key,)).fetchone()
+        return self._row(row) if row else None
+
+    def join(self, key):
+        with self._lock:
+            cursor = self._db.execute(
+                f"UPDATE job_state SET watchers = watchers + 1, heartbeat = ? WHERE key = ? "
+                f"AND job_id IS NOT NULL AND status NOT IN ({self._terminal})",
+                [time.time(), key] + self._terminal_args
+            )
+            if cursor.rowcount == 0:
+                return None
+            row = self._db.execute("SELECT * FROM job_state WHERE key = ?", (key,)).fetchone()
+        return self._row(row) if row else None
+
+    def touch(self, key, status, job_id, endpoint=None):
+        with self._lock:
+            self._db.execute(
+                f"UPDATE job_state SET status = ?, job_id = ?, endpoint = ?, heartbeat = ? WHERE key = ? "
+                f"AND status NOT IN ({self._terminal})",
+                [status, job_id, endpoint, time.time(), key] + self._terminal_args
+            )
+
+    def release(self, key):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("UPDATE job_state SET watchers = MAX(0, watchers - 1) WHERE key = ?", (key,))
+                row = self._db.execute("SELECT watchers FROM job_state WHERE key = ?", (key,)).fetchone()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return row["watchers"] if row else 0
+
+    def finish(self, key, status, error=None):
+        with self._lock:
+            self._db.execute(
+                f"UPDATE job_state SET status = ?, error = ?, heartbeat = ? WHERE key = ? "
+                f"AND status NOT IN ({self._terminal})",
+                [status, error, time.time(), key] + self._terminal_args
+            )
+
+    def claim_orphans(self, replica, stale_after, skip=()):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    f"SELECT * FROM job_state WHERE job_id IS NOT NULL AND status NOT IN ({self._terminal}) "
+                    f"AND heartbeat < ? AND (replica IS NULL OR replica != ?)",
+                    self._terminal_args + [now - stale_after, replica]
+                ).fetchall()
+                rows = [row for row in rows if row["key"] not in skip]
+                self._db.executemany(
+                    "UPDATE job_state SET replica = ?, heartbeat = ?, watchers = watchers + 1 WHERE key = ?",
+                    [(replica, now, row["key"]) for row in rows]
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        claimed = []
+        for row in rows:
+            record = self._row(row)
+            record.update(replica=replica, heartbeat=now, watchers=record["watchers"] + 1)
+            claimed.append(record)
+        return claimed
+
+    def prune(self, older_than):
+        with self._lock:
+            cutoff = time.time() - older_than
+            self._db.execute(
+                f"DELETE FROM job_state WHERE created_at < ? OR (status IN ({self._terminal}) AND heartbeat < ?)",
+                [cutoff] + self._terminal_args + [cutoff]
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,86 @@
+"""Adaptive status-poll scheduling.
+
+Learns how long jobs typically sit IN_QUEUE and IN_PROGRESS for each
+(width, height, steps) profile and spaces polls accordingly: sparse while the
+job is queued or far from its expected end, closing in on the expected end
+geometrically, then backing off again once it passes.
+"""
+import threading
+
+
+class PollScheduler:
+    def __init__(self, min_interval=0.5, max_interval=4.0, alpha=0.3,
+                 default_queue=5.0, default_run=20.0, window_polls=4):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.window_polls = window_polls
+        self.alpha = alpha
+        self.defaults = {"IN_QUEUE": default_queue, "IN_PROGRESS": default_run}
+        self._lock = threading.Lock()
+        # profile -> phase -> [mean seconds, mean absolute deviation, samples]
+        self._stats = {}
+
+    def _estimate(self, profile, phase):
+        with self._lock:
+            stats = self._stats.get(profile, {}).get(phase)
+            if stats is None:
+                default = self.defaults.get(phase, self.max_interval)
+                # Unknown profile: assume a wide window so we don't over-poll
+                return default, default / 2
+            return stats[0], stats[1]
+
+    def expected(self, profile):
+        queue, _ = self._estimate(profile, "IN_QUEUE")
+        run, _ = self._estimate(profile, "IN_PROGRESS")
+        return queue, run
+
+    def expected_total(self, profile):
+        return sum(self.expected(profile))
+
+    def next_delay(self, profile, phase, elapsed):
+        # elapsed counts from submission. The expected end of IN_PROGRESS is
+        # measured from submission too, so a late-observed start doesn't skew it
+        if phase not in self.defaults:
+            return self.min_interval
+        mean, spread = self._estimate(profile, "IN_QUEUE")
+        run_mean, run_spread = self._estimate(profile, "IN_PROGRESS")
+        if phase == "IN_QUEUE":
+            # A queued job can't finish before it leaves the queue and runs
+            # for at least the shortest likely run. Callers that want to see
+            # the run start (streamed previews) cap this themselves
+            delay = max(0.0, mean - spread - elapsed) + run_mean - run_spread
+            return max(self.min_interval, min(self.max_interval, delay))
+        mean += run_mean
+        spread += run_spread
+        window_start = mean - spread
+        window_end = mean + spread
+        # Spend at most window_polls polls on the likely-completion window
+        window_gap = (window_end - window_start) / self.window_polls
+        if elapsed < window_start:
+            # Sleep up to the start of the window, but keep checking at least
+            # every max_interval
+            delay = max(window_start - elapsed, window_gap)
+        elif elapsed <= window_end:
+            # Halve the distance to the expected end with each poll, rather
+            # than polling every min_interval across the whole window
+            delay = max(abs(mean - elapsed) / 2, window_gap)
+        else:
+            # Overran the estimate: back off gradually toward max_interval
+            overrun = (elapsed - window_end) / max(mean, 1.0)
+            delay = self.min_interval * (1 + 2 * overrun)
+        return max(self.min_interval, min(self.max_interval, delay))
+
+    def record(self, profile, phase, seconds):
+        if seconds is None or seconds < 0:
+            return
+        with self._lock:
+            phases = self._stats.setdefault(profile, {})
+            stats = phases.get(phase)
+            if stats is None:
+                phases[phase] = [seconds, seconds / 4, 1]
+                return
+            mean, spread, samples = stats
+            error = seconds - mean
+            mean += self.alpha * error
+            spread += self.alpha * (abs(error) - spread)
+            phases[phase] = [mean, spread, samples + 1]
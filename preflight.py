@@ -0,0 +1,134 @@
+"""Checks run on a rendered workflow before it is submitted.
+
+RunPod accepts any payload, so a broken graph, a LoRA file the worker doesn't
+have or a job too big to finish only fails after it has waited in the queue,
+sometimes only at the engine's timeout. Preflight catches these locally:
+validate_graph for node references, a worker manifest for LoRA files, and a
+cost model that estimates GPU-seconds from the sampler nodes (steps x latent
+megapixels x batch) so oversized jobs are refused before they take a slot.
+"""
+import json
+import re
+import threading
+
+from workflow_template import validate_graph
+
+LATENT_SOURCES = {"EmptyLatentImage", "EmptySD3LatentImage"}
+LORA_INPUT = re.compile(r"^lora_\d+$|^lora_name$")
+
+
+def lora_files(workflow):
+    # LoRA files the graph loads, from LoraLoader nodes and rgthree stacks
+    files = []
+    for node in workflow.values():
+        for name, value in node.get("inputs", {}).items():
+            if LORA_INPUT.match(name) and isinstance(value, str) and value != "None" and value not in files:
+                files.append(value)
+    return files
+
+
+def merge_duplicate_loras(lora_models, lora_strengths):
+    """Fold a LoRA chosen in several slots into its first slot.
+
+    LoRA deltas add to the weights, so one load at a + b is the same model as
+    two loads at a and b, without the second load. Empty ("None") slots get
+    strength 0, so their slider position can't change the workflow key.
+    """
+    models, strengths = list(lora_models), list(lora_strengths)
+    for i, model in enumerate(models):
+        if model == "None":
+            strengths[i] = 0.0
+            continue
+        first = models.index(model)
+        if first < i:
+            strengths[first] += strengths[i]
+            models[i], strengths[i] = "None", 0.0
+    return models, strengths
+
+
+def load_manifest(path):
+    """LoRA files the worker has, from a JSON file like {"loras": [...]}."""
+    with open(path) as f:
+        return frozenset(json.load(f)["loras"])
+
+
+def _latent(workflow, link, depth=0):
+    # (width, height, batch) of the latent a sampler input links to, or None
+    if not isinstance(link, list) or link[0] not in workflow or depth > 16:
+        return None
+    node = workflow[link[0]]
+    inputs = node.get("inputs", {})
+    if node.get("class_type") in LATENT_SOURCES:
+        return inputs.get("width"), inputs.get("height"), inputs.get("batch_size", 1)
+    upstream = inputs.get("samples", inputs.get("latent_image"))
+    source = _latent(workflow, upstream, depth + 1)
+    if "width" in inputs and "height" in inputs:
+        # LatentUpscale keeps the batch and sets the size
+        return inputs["width"], inputs["height"], source[2] if source else 1
+    if "scale_by" in inputs and source:
+        return source[0] * inputs["scale_by"], source[1] * inputs["scale_by"], source[2]
+    return source
+
+
+class CostModel:
+    """GPU-seconds of a workflow: overhead + seconds_per_unit x sampler work.
+
+    A unit is one sampler step over one megapixel of one image. The rate
+    starts at seconds_per_unit and follows completed jobs' run times, but
+    never drifts more than max_drift times away from that starting rate, so
+    a few slow runs (a cold worker loading models) can't make ordinary jobs
+    look too expensive to submit.
+    """
+
+    def __init__(self, seconds_per_unit=0.35, overhead=3.0, alpha=0.2, max_drift=2.0):
+        self.seconds_per_unit = seconds_per_unit
+        self.overhead = overhead
+        self.alpha = alpha
+        self.min_rate = seconds_per_unit / max_drift
+        self.max_rate = seconds_per_unit * max_drift
+        self._lock = threading.Lock()
+
+    def units(self, workflow):
+        total = 0.0
+        for node in workflow.values():
+            inputs = node.get("inputs", {})
+            steps = inputs.get("steps")
+            if not isinstance(steps, int) or "latent_image" not in inputs:
+                continue
+            latent = _latent(workflow, inputs["latent_image"])
+            width, height, batch = latent if latent and None not in latent else (1024, 1024, 1)
+            total += steps * width * height / 1e6 * batch
+        return total
+
+    def estimate(self, workflow):
+        return self.overhead + self.seconds_per_unit * self.units(workflow)
+
+    def record(self, workflow, run_seconds):
+        # Learn the rate from a completed job's IN_PROGRESS time
+        units = self.units(workflow)
+        if units <= 0 or run_seconds is None or run_seconds <= self.overhead:
+            return
+        rate = min(self.max_rate, max(self.min_rate, (run_seconds - self.overhead) / units))
+        with self._lock:
+            self.seconds_per_unit += self.alpha * (rate - self.seconds_per_unit)
+
+
+def preflight(workflow, available_loras=None, cost_model=None, max_gpu_seconds=None):
+    """Check a workflow graph before submitting it.
+
+    Returns (problems, estimated GPU-seconds); the job should only be
+    submitted when problems is empty. available_loras None skips the LoRA
+    check, and the estimate is None without a cost model.
+    """
+    problems = validate_graph(workflow)
+    if available_loras is not None:
+        missing = [name for name in lora_files(workflow) if name not in available_loras]
+        if missing:
+            problems.append(f"LoRA not available on the worker: {', '.join(missing)}")
+    seconds = None
+    if cost_model is not None and not problems:
+        seconds = cost_model.estimate(workflow)
+        if max_gpu_seconds and seconds > max_gpu_seconds:
+            problems.append(f"Estimated {seconds:.0f} GPU-seconds, over the {max_gpu_seconds:.0f} s limit "
+                            "per job; use fewer steps, a smaller size or fewer images")
+    return problems, seconds
@@ -0,0 +1,47 @@
+"""Prompt text as LoRA trigger-word segments in front of the user's own text.
+
+Selecting a LoRA prepends its trigger word; switching it swaps just that
+slot's segment. Because the model remembers which segments it inserted, it
+can split the current text back into (triggers, base) with one prefix
+comparison instead of lowercasing and scanning the whole prompt for every
+trigger word on every run; only the user's part is searched, for the one
+trigger being set. If the user edits inside the trigger words the
+prefix no longer matches, and the whole text simply becomes the base.
+"""
+
+
+class TriggerPrompt:
+    def __init__(self, slots=2):
+        # Trigger word of the LoRA selected in each slot ("" for none)...
+        self.triggers = [""] * slots
+        # ...and the one this model inserted for it, "" when another slot or
+        # the user's own text already has that word
+        self.segments = [""] * slots
+
+    def prefix(self):
+        parts = [segment for segment in self.segments if segment]
+        return " ".join(parts) + " " if parts else ""
+
+    def split(self, text):
+        """Return the user's part of text, forgetting segments that were edited away."""
+        prefix = self.prefix()
+        if text.startswith(prefix):
+            return text[len(prefix):]
+        self.segments = [""] * len(self.segments)
+        return text
+
+    def set_trigger(self, text, slot, trigger):
+        """Replace slot's trigger word in text; returns the new prompt text."""
+        base = self.split(text)
+        self.triggers[slot] = trigger
+        self.segments[slot] = ""
+        # A word this slot held may still be wanted by another slot with the
+        # same LoRA, so every slot without a segment gets another look.
+        # Skip a trigger the user already wrote (in any case), or that
+        # another slot inserted
+        for i, wanted in enumerate(self.triggers):
+            placed = [segment.lower() for segment in self.segments if segment]
+            if (wanted and not self.segments[i] and wanted.lower() not in placed
+                    and wanted.lower() not in base.lower()):
+                self.segments[i] = wanted
+        return self.prefix() + base
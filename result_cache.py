@@ -0,0 +1,132 @@
+"""Content-addressed cache for generated images.
+
+Results are keyed on a canonical hash of the ComfyUI workflow
+(workflow_template.RenderedWorkflow.key), so identical requests (same prompt,
+size, steps, seed and LoRA stack) are served without a RunPod round trip. Entries live in a small in-memory LRU tier backed by an
+on-disk tier that is bounded by total size and evicted least-recently-used.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_disk_bytes=512 * 1024 * 1024, max_memory_bytes=64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> bytes, oldest first
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> size, oldest first
+        self._disk_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_disk_index()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.bin")
+
+    def _load_disk_index(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".bin"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, name[:-4], info.st_size))
+        # Rebuild recency order from file mtimes, which get refreshed on every hit
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def _remember(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+                self.memory_hits += 1
+                return data
+
+            if key in self._disk:
+                path = self._path(key)
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    os.utime(path)
+                except OSError:
+                    # File vanished underneath us; forget it and treat as a miss
+                    self._disk_bytes -= self._disk.pop(key)
+                else:
+                    self._disk.move_to_end(key)
+                    self._remember(key, data)
+                    self.disk_hits += 1
+                    return data
+
+            self.misses += 1
+            return None
+
+    def put(self, key, data):
+        with self._lock:
+            self._remember(key, data)
+            path = self._path(key)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError:
+                # The memory tier still holds the result; disk is best-effort
+                return
+            if key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._evict_disk()
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
@@ -0,0 +1,119 @@
+"""Pooled HTTP client for the RunPod serverless API.
+
+A single client is meant to be shared by the whole process so status polls
+reuse kept-alive TLS connections instead of opening a new one per request.
+Responses are requested gzipped: a completed status carries the images as
+base64, which compresses back to roughly its binary size in transit.
+"""
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RUNPOD_API_URL = "https://api.runpod.ai/v2"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RunPodClient:
+    def __init__(self, endpoint_id, api_key, base_url=None, pool_size=20,
+                 connect_timeout=5, read_timeout=30, max_retries=4,
+                 backoff_base=0.5, backoff_max=8.0):
+        self.endpoint_id = endpoint_id
+        self.base_url = base_url or f"{RUNPOD_API_URL}/{endpoint_id}"
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'Authorization': f'Bearer {api_key}'
+        })
+        # pool_maxsize is how many kept-alive connections are retained per host;
+        # bursts beyond it still go through but their connections aren't reused
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        # "Full jitter": uniform over [0, capped exponential] so retries from
+        # many sessions don't land on the endpoint in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _request(self, method, path, retry=False, timeout=None, decode=True, **kwargs):
+        # path is relative to the endpoint, or an absolute URL
+        url = path if path.startswith(("http://", "https://")) else f"{self.base_url}{path}"
+        timeout = timeout or self.timeout
+        attempts = self.max_retries + 1 if retry else 1
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if last_attempt:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+
+            if response.status_code in RETRY_STATUS_CODES and not last_attempt:
+                retry_after = response.headers.get("Retry-After")
+                try:
+                    retry_after = min(float(retry_after), self.backoff_max) if retry_after else None
+                except ValueError:
+                    retry_after = None
+                response.close()
+                time.sleep(self._backoff(attempt, retry_after))
+                continue
+
+            response.raise_for_status()
+            return response.json() if decode else response.content
+
+    def _body(self, payload):
+        # Payloads may arrive pre-serialized (see workflow_template) to skip a
+        # json.dumps of the whole workflow on every submit
+        if isinstance(payload, str):
+            return {"data": payload.encode("utf-8")}
+        return {"json": payload}
+
+    def run(self, payload):
+        # Submitting is not idempotent, so a failure here is never retried
+        return self._request("POST", "/run", **self._body(payload))
+
+    def runsync(self, payload, wait=60):
+        # RunPod holds the request open for up to `wait` seconds; a job that
+        # isn't finished by then comes back with its id and is polled as usual
+        connect_timeout, read_timeout = self.timeout
+        return self._request(
+            "POST", "/runsync",
+            params={"wait": int(wait * 1000)},
+            **self._body(payload),
+            timeout=(connect_timeout, wait + read_timeout)
+        )
+
+    def status(self, job_id):
+        return self._request("GET", f"/status/{job_id}", retry=True)
+
+    def stream(self, job_id):
+        # Output chunks a generator worker has yielded since the last call
+        return self._request("GET", f"/stream/{job_id}", retry=True)
+
+    def cancel(self, job_id):
+        # Cancelling twice is harmless, so this is retried like status
+        return self._request("POST", f"/cancel/{job_id}", retry=True)
+
+    def health(self):
+        # Worker and job counts for the whole endpoint
+        return self._request("GET", "/health", retry=True)
+
+    def fetch(self, url):
+        # Image bytes a worker uploaded instead of returning them inline; the
+        # API key is not sent to the (pre-signed) storage URL
+        return self._request("GET", url, retry=True, decode=False, headers={"Authorization": None})
+
+    def close(self):
+        self.session.close()
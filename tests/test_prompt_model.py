@@ -0,0 +1,25 @@
+from prompt_model import TriggerPrompt
+
+
+def test_set_trigger_prepends_and_swaps():
+    prompt = TriggerPrompt(slots=2)
+    text = prompt.set_trigger("a bowl", 0, "SomTumThai")
+    assert text == "SomTumThai a bowl"
+    assert prompt.set_trigger(text, 0, "WaiKru") == "WaiKru a bowl"
+
+
+def test_trigger_typed_in_other_case_is_not_added():
+    prompt = TriggerPrompt(slots=2)
+    assert prompt.set_trigger("a somtumthai dish", 0, "SomTumThai") == "a somtumthai dish"
+
+
+def test_shared_trigger_moves_to_remaining_slot():
+    # Both slots pick the same LoRA; changing the first must keep the word
+    # the second slot still needs
+    prompt = TriggerPrompt(slots=2)
+    text = prompt.set_trigger("a bowl", 0, "SomTumThai")
+    text = prompt.set_trigger(text, 1, "SomTumThai")
+    assert text == "SomTumThai a bowl"
+    text = prompt.set_trigger(text, 0, "WaiKru")
+    assert text == "WaiKru SomTumThai a bowl"
+    assert prompt.set_trigger(text, 1, "") == "WaiKru a bowl"
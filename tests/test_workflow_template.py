@@ -0,0 +1,31 @@
+import itertools
+
+from workflow_template import WorkflowTemplate, scaled_size
+
+SIZES = [512, 576, 640, 704, 768, 832, 896, 960, 1024]
+
+
+def test_scaled_size_keeps_aspect_ratio():
+    # A draft is upscaled to the full size, so it must have the same shape
+    for width, height in itertools.product(SIZES, repeat=2):
+        draft_width, draft_height = scaled_size(width, height, 512)
+        assert max(draft_width, draft_height) <= 512
+        assert abs((draft_width / draft_height) / (width / height) - 1) < 0.025, (width, height)
+
+
+def test_scaled_size_rounds_to_multiple():
+    assert scaled_size(1024, 576, 512) == (512, 288)
+    assert all(side % 16 == 0 for side in scaled_size(1000, 700, 512))
+
+
+def test_scaled_size_never_enlarges():
+    assert scaled_size(320, 240, 512) == (320, 240)
+
+
+def test_output_options_change_the_key():
+    template = WorkflowTemplate.load("workflows/flux_lora_stack.json").compile()
+    jpeg = template.render(prompt="a bowl", output={"format": "JPEG", "quality": 92})
+    png = template.render(prompt="a bowl", output={"format": "PNG", "quality": 92})
+    assert jpeg.json == png.json
+    assert jpeg.key != png.key
+    assert '"output":{"format":"JPEG","quality":92}' in jpeg.payload()
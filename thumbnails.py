@@ -0,0 +1,117 @@
+"""Small, cached variants of the LoRA preview images.
+
+The source previews are 0.5-1 MB JPEGs but are only ever shown as small
+cards, so we render thumbnails once and keep a manifest keyed by the source
+file's content hash. Unchanged sources are never re-rendered; edited ones
+are picked up automatically.
+
+JPEG is the default because of how st.image treats formats (see
+image_result); WebP is available for serving the files some other way.
+
+Thumbnails are built on first use by the app, or ahead of time with:
+
+    python thumbnails.py assets/lora_previews [out_dir] [JPEG|WEBP]
+"""
+import hashlib
+import io
+import json
+import os
+import sys
+
+from PIL import Image, features
+
+MANIFEST_NAME = "manifest.json"
+
+
+def _thumbnail_format(image_format):
+    if image_format == "WEBP" and features.check("webp"):
+        return "WEBP", "webp"
+    return "JPEG", "jpg"
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def render_thumbnail(source, max_size, image_format="JPEG", quality=80):
+    # source is a path or a file object
+    with Image.open(source) as image:
+        image = image.convert("RGB")
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+        options = {"quality": quality}
+        if image_format == "WEBP":
+            options["method"] = 6  # slowest encoder setting, smallest files; runs once per source
+        else:
+            options["optimize"] = True
+        buffer = io.BytesIO()
+        image.save(buffer, format=image_format, **options)
+        return buffer.getvalue()
+
+
+def build_thumbnails(sources, out_dir, max_size=512, quality=80, image_format="JPEG"):
+    """Render missing or stale thumbnails and return the manifest.
+
+    The manifest maps each source path to its content hash and thumbnail
+    file. Sources that don't exist are left out.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    image_format, extension = _thumbnail_format(image_format)
+    old_manifest = _load_manifest(out_dir)
+    manifest = {}
+    for source in sources:
+        if not source or not os.path.exists(source):
+            continue
+        content_hash = _file_hash(source)
+        name = f"{content_hash[:16]}_{max_size}_q{quality}.{extension}"
+        path = os.path.join(out_dir, name)
+        entry = old_manifest.get(source)
+        if not (entry and entry.get("thumbnail") == name and os.path.exists(path)):
+            data = render_thumbnail(source, max_size, image_format, quality)
+            with open(path, "wb") as f:
+                f.write(data)
+        manifest[source] = {
+            "sha256": content_hash,
+            "thumbnail": name,
+            "bytes": os.path.getsize(path),
+            "source_bytes": os.path.getsize(source),
+        }
+
+    if manifest != old_manifest:
+        with open(os.path.join(out_dir, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_thumbnails(sources, out_dir, max_size=512, quality=80, image_format="JPEG"):
+    # Source path -> thumbnail bytes, ready to hand to st.image
+    manifest = build_thumbnails(sources, out_dir, max_size=max_size, quality=quality,
+                                image_format=image_format)
+    thumbnails = {}
+    for source, entry in manifest.items():
+        with open(os.path.join(out_dir, entry["thumbnail"]), "rb") as f:
+            thumbnails[source] = f.read()
+    return thumbnails
+
+
+if __name__ == "__main__":
+    source_dir = sys.argv[1] if len(sys.argv) > 1 else "assets/lora_previews"
+    out_dir = sys.argv[2] if len(sys.argv) > 2 else ".cache/thumbnails"
+    image_format = sys.argv[3].upper() if len(sys.argv) > 3 else "JPEG"
+    sources = sorted(
+        os.path.join(source_dir, name) for name in os.listdir(source_dir)
+        if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))
+    )
+    for source, entry in build_thumbnails(sources, out_dir, image_format=image_format).items():
+        print(f"{source}: {entry['source_bytes'] // 1024} KB -> {entry['bytes'] // 1024} KB ({entry['thumbnail']})")
@@ -0,0 +1,144 @@
+"""Keep RunPod workers warm and report endpoint health.
+
+A cold worker has to start and load the Flux UNET, the T5/CLIP encoders and
+any LoRAs before the first job runs, which can take a large share of the job
+timeout. The warm pool polls the endpoint's /health every check_interval and,
+while the app is in use (or during the configured warm hours), submits a
+cheap warm-up job whenever no worker is ready. Warm-up jobs are tiny
+low-priority renders that use the most popular LoRAs, so the worker that
+picks them up has those LoRAs loaded too.
+
+The last /health snapshot is kept for the UI and exported as gauges, and the
+endpoint state ("warm", "cold" or "unknown") is what generation jobs are
+labelled with (worker_state), so cold-start latency shows up separately in the metrics.
+"""
+import threading
+import time
+from collections import Counter
+
+import requests
+
+
+class WarmPool:
+    def __init__(self, engine, build_warmup, slots=2, check_interval=30, keep_warm_for=900,
+                 warmup_gap=120, warm_hours=None, metrics=None):
+        self.engine = engine
+        # build_warmup(lora_models) -> payload of a minimal generation
+        self.build_warmup = build_warmup
+        self.slots = slots
+        self.check_interval = check_interval
+        # Warm up only within keep_warm_for seconds of the last user activity...
+        self.keep_warm_for = keep_warm_for
+        # ...or while the local hour is in warm_hours, e.g. range(9, 18)
+        self.warm_hours = warm_hours
+        self.warmup_gap = warmup_gap
+        self.metrics = metrics
+        self.usage = Counter()  # LoRA name -> generations using it
+        self.health = None
+        self.checked_at = None
+        self.error = None
+        self.last_activity = None
+        self.last_warmup = None
+        self.warmups = 0
+        self._warmup_handle = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="runpod-warm-pool", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def touch(self, lora_models=()):
+        # Called for page views (no LoRAs) and generations (their LoRA stack)
+        idle = not self.wanted()
+        with self._lock:
+            self.last_activity = time.time()
+            self.usage.update(model for model in lora_models if model != "None")
+        if idle:
+            # First activity after a quiet spell: check now rather than at
+            # the next interval, so the worker starts while the user types
+            self._wake.set()
+
+    def popular_loras(self):
+        with self._lock:
+            popular = [model for model, _ in self.usage.most_common(self.slots)]
+        return popular + ["None"] * (self.slots - len(popular))
+
+    def workers_ready(self):
+        if self.health is None:
+            return None
+        workers = self.health.get("workers", {})
+        return workers.get("idle", 0) + workers.get("ready", 0) + workers.get("running", 0)
+
+    def state(self):
+        ready = self.workers_ready()
+        if ready is None:
+            return "unknown"
+        return "warm" if ready else "cold"
+
+    def wanted(self, now=None):
+        now = now or time.time()
+        if self.warm_hours is not None and time.localtime(now).tm_hour in self.warm_hours:
+            return True
+        return self.last_activity is not None and now - self.last_activity < self.keep_warm_for
+
+    def check(self):
+        """Refresh the health snapshot and warm up a worker if needed."""
+        try:
+            self.health = self.engine.health()
+            self.error = None
+        except requests.exceptions.RequestException as e:
+            self.error = str(e)
+            return
+        finally:
+            self.checked_at = time.time()
+
+        jobs = self.health.get("jobs", {})
+        if self.workers_ready() or jobs.get("inQueue", 0) or jobs.get("inProgress", 0):
+            # Already warm, or real jobs are bringing a worker up anyway
+            return
+        if not self.wanted():
+            return
+        if self._warmup_handle is not None and not self._warmup_handle.done():
+            return
+        if self.last_warmup and time.time() - self.last_warmup < self.warmup_gap:
+            return
+        self.warmup()
+
+    def warmup(self):
+        loras = self.popular_loras()
+        self._warmup_handle = self.engine.submit(
+            self.build_warmup(loras), profile="warmup", session="warm-pool", priority="background", loras=loras,
+            labels={"resolution": "warmup", "steps": "1", "worker_state": self.state(), "loras": "+".join(
+                model.replace(".safetensors", "") for model in loras)}
+        )
+        self.last_warmup = time.time()
+        self.warmups += 1
+        if self.metrics is not None:
+            self.metrics.counter("runpod_warmup_jobs_total", "Warm-up jobs submitted by the warm pool").inc()
+        return self._warmup_handle
+
+    def gauges(self):
+        # For MetricsRegistry.add_collector
+        gauges = [("runpod_endpoint_warm", "1 when the last health check saw a ready worker",
+                   1 if self.state() == "warm" else 0, {})]
+        if self.health is not None:
+            for state, count in sorted(self.health.get("workers", {}).items()):
+                gauges.append(("runpod_workers", "Endpoint workers by state", count, {"state": state}))
+            for state, count in sorted(self.health.get("jobs", {}).items()):
+                gauges.append(("runpod_endpoint_jobs", "Endpoint jobs by state", count, {"state": state}))
+        return gauges
+
+    def _run(self):
+        while not self._stopped:
+            self.check()
+            self._wake.wait(self.check_interval)
+            self._wake.clear()
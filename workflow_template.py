@@ -0,0 +1,178 @@
+"""Versioned ComfyUI workflow templates compiled to pre-serialized JSON.
+
+A template file (see workflows/) holds the node graph with "{{name}}"
+placeholders for the handful of values that change per request, plus the
+declared type and default of each slot. Compiling serializes the graph once
+in canonical form (sorted keys, compact separators) and splits it at the
+placeholders, so rendering a request is just JSON-encoding the slot values
+and joining strings. The rendered text is the same canonical form
+canonical_json gives a workflow dict, so RenderedWorkflow.key (the result
+cache key) can hash it, and it can be diffed and submitted without ever
+building the nested dict.
+"""
+import hashlib
+import json
+import re
+
+SLOT_PATTERN = re.compile(r'"\{\{([A-Za-z_][A-Za-z0-9_]*)\}\}"')
+SLOT_TYPES = {
+    "str": (str,),
+    "int": (int,),
+    "number": (int, float),
+}
+
+
+def canonical_json(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def expected_images(workflow):
+    saves = sum(1 for node in workflow.values() if node.get("class_type") == "SaveImage")
+    batch_size = workflow.get("27", {}).get("inputs", {}).get("batch_size", 1)
+    return saves * batch_size
+
+
+def scaled_size(width, height, longest, multiple=16):
+    """(width, height) shrunk so the longer side is at most longest.
+
+    Both sides get the same scale factor before rounding to a multiple of
+    multiple (Flux latents are 1/8 of the image and patched 2x2), so the
+    aspect ratio stays within a rounding step of the original.
+    """
+    scale = min(1.0, longest / max(width, height))
+    return tuple(max(multiple, round(side * scale / multiple) * multiple) for side in (width, height))
+
+
+def validate_graph(workflow):
+    """Return a list of problems with the node graph (empty when it's sound)."""
+    problems = []
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or "class_type" not in node:
+            problems.append(f"Node {node_id} has no class_type")
+            continue
+        for name, value in node.get("inputs", {}).items():
+            # Links are [source_node_id, output_index]
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[0], str):
+                if value[0] not in workflow:
+                    problems.append(f"Node {node_id} input '{name}' links to missing node {value[0]}")
+                elif not isinstance(value[1], int) or value[1] < 0:
+                    problems.append(f"Node {node_id} input '{name}' has invalid output index {value[1]}")
+    return problems
+
+
+class RenderedWorkflow:
+    """A filled-in workflow as canonical JSON, with its hash and dict form on demand.
+
+    output holds the worker's encoding options (format, quality, transfer).
+    They change the bytes that come back, so they are part of the key and
+    sent with every payload.
+    """
+
+    __slots__ = ("json", "images", "output", "_key", "_workflow")
+
+    def __init__(self, workflow_json, images=1, workflow=None, output=None):
+        self.json = workflow_json
+        self.images = images
+        self.output = output
+        self._key = None
+        self._workflow = workflow
+
+    @classmethod
+    def from_dict(cls, workflow, output=None):
+        return cls(canonical_json(workflow), images=expected_images(workflow), workflow=workflow, output=output)
+
+    @property
+    def key(self):
+        if self._key is None:
+            text = self.json if self.output is None else self.json + canonical_json(self.output)
+            self._key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return self._key
+
+    @property
+    def workflow(self):
+        # Parsed lazily, only for callers that need to edit the graph
+        if self._workflow is None:
+            self._workflow = json.loads(self.json)
+        return self._workflow
+
+    def payload(self, **options):
+        # Extra input fields for the worker (e.g. preview settings) go next
+        # to the workflow; None values are left out
+        options = dict(options, output=self.output)
+        extra = "".join(
+            f"{json.dumps(name)}:{canonical_json(value)},"
+            for name, value in sorted(options.items()) if value is not None
+        )
+        return '{"input":{' + extra + '"workflow":' + self.json + '}}'
+
+
+class WorkflowTemplate:
+    def __init__(self, name, version, slots, workflow):
+        self.name = name
+        self.version = version
+        self.slots = slots
+        self.workflow = workflow
+        self._chunks = None
+        self._tail = None
+        self._saves = None
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            spec = json.load(f)
+        return cls(spec["name"], spec["version"], spec["slots"], spec["workflow"])
+
+    def compile(self):
+        problems = validate_graph(self.workflow)
+        if problems:
+            raise ValueError(f"Invalid workflow template {self.name} v{self.version}: " + "; ".join(problems))
+
+        skeleton = canonical_json(self.workflow)
+        chunks = []
+        position = 0
+        used = set()
+        for match in SLOT_PATTERN.finditer(skeleton):
+            slot = match.group(1)
+            if slot not in self.slots:
+                raise ValueError(f"Workflow template {self.name} uses undeclared slot '{slot}'")
+            chunks.append((skeleton[position:match.start()], slot))
+            used.add(slot)
+            position = match.end()
+        unused = set(self.slots) - used
+        if unused:
+            raise ValueError(f"Workflow template {self.name} declares unused slots: {', '.join(sorted(unused))}")
+
+        self._chunks = chunks
+        self._tail = skeleton[position:]
+        self._saves = sum(1 for node in self.workflow.values() if node["class_type"] == "SaveImage")
+        return self
+
+    def _check(self, params):
+        unknown = set(params) - set(self.slots)
+        if unknown:
+            raise ValueError(f"Unknown workflow parameters: {', '.join(sorted(unknown))}")
+        values = {}
+        for slot, spec in self.slots.items():
+            if slot in params:
+                value = params[slot]
+            elif "default" in spec:
+                value = spec["default"]
+            else:
+                raise ValueError(f"Missing workflow parameter '{slot}'")
+            expected = SLOT_TYPES[spec["type"]]
+            # bool is an int subclass but never a valid ComfyUI number here
+            if isinstance(value, bool) or not isinstance(value, expected):
+                raise ValueError(f"Workflow parameter '{slot}' must be {spec['type']}, got {type(value).__name__}")
+            values[slot] = value
+        return values
+
+    def render(self, output=None, **params):
+        if self._chunks is None:
+            self.compile()
+        values = self._check(params)
+        parts = []
+        for literal, slot in self._chunks:
+            parts.append(literal)
+            parts.append(json.dumps(values[slot], ensure_ascii=False))
+        parts.append(self._tail)
+        return RenderedWorkflow("".join(parts), images=self._saves * values.get("batch_size", 1), output=output)